@@ -0,0 +1,95 @@
+"""Запуск нескольких ботов в одном процессе.
+
+Каждая папка внутри BOTS_DIR, в которой есть config.yml, - отдельный бот со своими
+данными (users.db, logs, auto_message.yml, изображения). Общими для всех ботов
+остаются HTTP-сессия с пулом соединений, цикл событий с задачами рассылок и пул воркеров
+исходящих сообщений вместе с контролем нагрузки на Telegram API.
+
+    python bot_host.py bots
+"""
+import asyncio
+import importlib.util
+import logging
+import signal
+import sys
+from pathlib import Path
+from types import ModuleType
+from typing import List
+
+from aiogram.client.session.aiohttp import AiohttpSession
+
+BOT_MODULE = Path(__file__).with_name("telegram_bot.py")
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S"
+)
+logger = logging.getLogger("bot_host")
+
+def load_bot(home: Path, shared: dict) -> ModuleType:
+    """Отдельный экземпляр модуля telegram_bot для бота из папки home"""
+    spec = importlib.util.spec_from_file_location(f"telegram_bot_{home.name}", BOT_MODULE)
+    module = importlib.util.module_from_spec(spec)
+    module.BOT_HOME = home
+    module.BOT_NAME = home.name
+    module.SHARED = shared
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def load_bots(bots_dir: Path, shared: dict) -> List[ModuleType]:
+    bots = []
+    for config_path in sorted(bots_dir.glob("*/config.yml")):
+        try:
+            bots.append(load_bot(config_path.parent, shared))
+            logger.info(f"Загружен бот {config_path.parent.name}")
+        except Exception as e:
+            logger.error(f"Не удалось загрузить бота {config_path.parent.name}: {str(e)}")
+    return bots
+
+async def run_bots(bots_dir: Path):
+    shared = {"session": AiohttpSession()}
+    bots = load_bots(bots_dir, shared)
+    if not bots:
+        logger.error(f"В {bots_dir} нет папок с config.yml")
+        await shared["session"].close()
+        return
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    # Пул воркеров отправки общий и живет, пока работает хост, а не первый загруженный бот
+    outbound = shared["outbound"]
+    outbound.start()
+
+    polling = [asyncio.create_task(module.run_bot(), name=module.BOT_NAME) for module in bots]
+    stopping = asyncio.create_task(stop_event.wait())
+    logger.info(f"Запущено ботов: {len(bots)}")
+
+    # Ошибка одного бота (например, неверный токен) не останавливает остальных
+    pending = set(polling)
+    while pending and not stop_event.is_set():
+        done, pending = await asyncio.wait(pending | {stopping}, return_when=asyncio.FIRST_COMPLETED)
+        pending.discard(stopping)
+        for task in done:
+            if task is not stopping and task.exception():
+                logger.error(f"Бот {task.get_name()} остановлен с ошибкой: {str(task.exception())}")
+
+    stopping.cancel()
+    await asyncio.gather(*(module.dp.stop_polling() for module in bots), return_exceptions=True)
+    await asyncio.gather(*polling, return_exceptions=True)
+    await outbound.stop()
+    await shared["session"].close()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(run_bots(Path(sys.argv[1] if len(sys.argv) > 1 else "bots")))
+    except KeyboardInterrupt:
+        pass
+    logger.info("Боты остановлены")
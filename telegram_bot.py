@@ -1,12 +1,27 @@
 import yaml
 import os
-import asyncio
 import sys
+import asyncio
 import sqlite3
 import logging
+import re
+import json
+import csv
+import hashlib
+import mmap
+import weakref
+from array import array
+from bisect import bisect_left
+import socket
+import tempfile
+import contextvars
+from collections import deque
+from contextlib import asynccontextmanager, AsyncExitStack
+from functools import lru_cache
 from html import escape
-from datetime import datetime, time
-from typing import List, Dict, Set, Optional, Callable, Awaitable, Any, Union
+from datetime import datetime, time, timedelta
+from time import monotonic
+from typing import List, Dict, Set, Tuple, Optional, Callable, Awaitable, Any, Union, Iterable, Iterator, Sequence
 import logging.handlers
 from pathlib import Path
 
@@ -20,13 +35,29 @@ from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     FSInputFile,
-    InputMediaPhoto
+    InputMediaPhoto,
+    InlineQueryResultArticle,
+    InlineQueryResultCachedPhoto,
+    InputTextMessageContent
 )
 from aiogram.enums import ChatAction
+from aiogram.exceptions import (
+    TelegramRetryAfter,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNotFound,
+    TelegramConflictError,
+    TelegramUnauthorizedError,
+    TelegramEntityTooLarge,
+    TelegramServerError,
+    TelegramNetworkError
+)
 from aiogram.client.default import DefaultBotProperties
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
+STARTED_AT = monotonic()
+
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -34,13 +65,20 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 bot_running = True
-bot_task = None
 
-LOGS_DIR = Path("logs")
+# bot_host.py загружает этот модуль отдельно для каждого бота и перед выполнением задает BOT_HOME
+# (папка с config.yml и данными бота), BOT_NAME и SHARED (общие для ботов HTTP-сессия и пул отправки)
+BOT_HOME = Path(globals().get("BOT_HOME", "."))
+BOT_NAME: Optional[str] = globals().get("BOT_NAME")
+SHARED: dict = globals().get("SHARED", {})
+
+LOGS_DIR = BOT_HOME / "logs"
 LOGS_DIR.mkdir(exist_ok=True)
 
 LOG_DATE_FORMAT = "%Y-%m-%d_%H-%M-%S"
 
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 log_counter = 1
 
 class BlockCheckMiddleware(BaseMiddleware):
@@ -75,8 +113,164 @@ class BlockCheckMiddleware(BaseMiddleware):
 
         return await handler(event, data)
 
+class Lifecycle:
+    """Учет фоновых задач бота и корректная остановка по сигналу"""
+
+    def __init__(self):
+        self.tasks: Set[asyncio.Task] = set()
+        self.shutdown_hooks: List[Callable[[], Awaitable[Any]]] = []
+        self.stop_event = asyncio.Event()
+        self.last_update_id: Optional[int] = None
+
+    @property
+    def stopping(self) -> bool:
+        return self.stop_event.is_set()
+
+    def spawn(self, coro, name: str = None) -> asyncio.Task:
+        """Запуск фоновой задачи вместо голого asyncio.create_task"""
+        task = asyncio.create_task(coro, name=name)
+        self.track(task)
+        return task
+
+    def track(self, task: asyncio.Task):
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def on_shutdown(self, hook: Callable[[], Awaitable[Any]]):
+        """Регистрирует корутину, которая сбрасывает данные перед закрытием сессии"""
+        self.shutdown_hooks.append(hook)
+        return hook
+
+    async def sleep(self, seconds: float) -> bool:
+        """Ожидание, прерываемое остановкой бота. Возвращает True, если бот останавливается"""
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+        return self.stopping
+
+    async def shutdown(self, timeout: float):
+        """Останавливает прием работы, дожидается задач в пределах timeout и сбрасывает хранилища"""
+        global bot_running
+        bot_running = False
+        self.stop_event.set()
+
+        current = asyncio.current_task()
+        pending = {task for task in self.tasks if task is not current and not task.done()}
+
+        if pending:
+            logger.info(f"Ожидаем завершения {len(pending)} задач (не более {timeout} сек.)")
+            _, pending = await asyncio.wait(pending, timeout=timeout)
+
+        if pending:
+            logger.warning(f"Отменяем {len(pending)} незавершенных задач по истечении времени")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        for hook in self.shutdown_hooks:
+            try:
+                await hook()
+            except Exception as e:
+                logger.error(f"Ошибка при остановке ({getattr(hook, '__name__', hook)}): {str(e)}")
+
+lifecycle = Lifecycle()
+
+class TaskTrackingMiddleware(BaseMiddleware):
+    """Регистрирует обработку каждого апдейта в Lifecycle, чтобы дождаться ее при остановке"""
+
+    async def __call__(
+            self,
+            handler: Callable[[types.Update, Dict[str, Any]], Awaitable[Any]],
+            event: types.Update,
+            data: Dict[str, Any]
+    ) -> Any:
+        task = asyncio.current_task()
+        if task is not None:
+            lifecycle.track(task)
+
+        try:
+            return await handler(event, data)
+        finally:
+            if lifecycle.last_update_id is None or event.update_id > lifecycle.last_update_id:
+                lifecycle.last_update_id = event.update_id
+
+class RecentIds:
+    """Ограниченное множество последних ключей: старые вытесняются по мере добавления новых"""
+
+    def __init__(self, maxlen: int):
+        self.order = deque(maxlen=maxlen)
+        self.keys = set()
+
+    def add(self, key) -> bool:
+        """Добавляет ключ, возвращает False, если он уже был"""
+        if key in self.keys:
+            return False
+        if len(self.order) == self.order.maxlen:
+            self.keys.discard(self.order[0])
+        self.order.append(key)
+        self.keys.add(key)
+        return True
+
+class DuplicateUpdateMiddleware(BaseMiddleware):
+    """Пропускает апдейты, которые уже обрабатывались (повторная выдача после перезапуска поллинга)"""
+
+    def __init__(self, maxlen: int = 10000):
+        self.recent = RecentIds(maxlen)
+
+    async def __call__(
+            self,
+            handler: Callable[[types.Update, Dict[str, Any]], Awaitable[Any]],
+            event: types.Update,
+            data: Dict[str, Any]
+    ) -> Any:
+        if not self.recent.add(event.update_id):
+            logger.info(f"Апдейт {event.update_id} уже обработан, пропускаем")
+            return None
+        return await handler(event, data)
+
+class CallbackDebounceMiddleware(BaseMiddleware):
+    """Повторные нажатия той же инлайн-кнопки в том же чате, пока предыдущее обрабатывается
+    или не прошло window секунд после него, сразу получают ответ без повторной отправки"""
+
+    def __init__(self, window: float, max_entries: int = 10000):
+        self.window = window
+        self.max_entries = max_entries
+        self.busy_until: Dict[tuple, float] = {}
+
+    def prune(self, now: float):
+        for key in [key for key, until in self.busy_until.items() if until <= now]:
+            del self.busy_until[key]
+
+    async def __call__(
+            self,
+            handler: Callable[[CallbackQuery, Dict[str, Any]], Awaitable[Any]],
+            event: CallbackQuery,
+            data: Dict[str, Any]
+    ) -> Any:
+        chat_id = event.message.chat.id if event.message else event.from_user.id
+        key = (chat_id, event.data)
+        now = monotonic()
+
+        if self.busy_until.get(key, 0) > now:
+            logger.info(f"Повторное нажатие '{event.data}' в чате {chat_id}, пропускаем")
+            await event.answer()
+            return None
+
+        if len(self.busy_until) >= self.max_entries:
+            self.prune(now)
+
+        self.busy_until[key] = float("inf")
+        try:
+            return await handler(event, data)
+        finally:
+            self.busy_until[key] = monotonic() + self.window
+
 dp = Dispatcher()
 
+dp.update.outer_middleware(TaskTrackingMiddleware())
+dp.update.outer_middleware(DuplicateUpdateMiddleware())
+
 dp.message.middleware(BlockCheckMiddleware())
 dp.callback_query.middleware(BlockCheckMiddleware())
 
@@ -86,25 +280,158 @@ class BroadcastStates(StatesGroup):
 class RefundStates(StatesGroup):
     waiting_confirmation = State()
 
-with open("config.yml", "r", encoding="utf-8") as f:
-    config = yaml.safe_load(f)
+def load_yaml(path: Union[str, Path]):
+    """Читает YAML через libyaml (CSafeLoader), если он установлен: это в несколько раз быстрее
+    чистого Python, и отдельный кэш разобранного файла не нужен"""
+    with open(path, "rb") as f:
+        return yaml.load(f, Loader=YAML_LOADER)
+
+def resolve_media_paths(data):
+    """Относительные пути image/images считаются от папки бота"""
+    if isinstance(data, list):
+        for item in data:
+            resolve_media_paths(item)
+    elif isinstance(data, dict):
+        for key, value in data.items():
+            if key == "image" and isinstance(value, str) and not os.path.isabs(value):
+                data[key] = str(BOT_HOME / value)
+            elif key == "images" and isinstance(value, list):
+                data[key] = [
+                    str(BOT_HOME / path) if isinstance(path, str) and not os.path.isabs(path) else path
+                    for path in value
+                ]
+            else:
+                resolve_media_paths(value)
+    return data
+
+config = load_yaml(BOT_HOME / "config.yml")
 
 try:
-    with open("auto_message.yml", "r", encoding="utf-8") as f:
-        auto_messages = yaml.safe_load(f) or {}
-        scheduled_messages = auto_messages.get("scheduled", {})
-        template_messages = auto_messages.get("templates", {})
+    auto_messages = load_yaml(BOT_HOME / "auto_message.yml") or {}
 except FileNotFoundError:
     logger.warning("Файл auto_message.yml не найден, рассылка отключена")
-    scheduled_messages = {}
-    template_messages = {}
+    auto_messages = {}
+
+scheduled_messages = auto_messages.get("scheduled", {})
+template_messages = auto_messages.get("templates", {})
+
+if BOT_NAME:
+    resolve_media_paths(config)
+    resolve_media_paths(auto_messages)
+
+DEFAULT_LANGUAGE = str(config.get("default_language", "ru")).lower()
+
+class ContentBundle:
+    """Команды, кнопки, ответ на неизвестное сообщение и шаблоны одного языка.
+    Собирается один раз при загрузке, поэтому поиск по нажатой кнопке - одно обращение к dict"""
+
+    __slots__ = ("language", "commands", "buttons", "menu", "unknown_message", "templates")
+
+    def __init__(self, language: str, commands: dict, buttons: dict, menu: dict,
+                 unknown_message: Optional[dict], templates: dict):
+        self.language = language
+        self.commands = commands
+        self.buttons = buttons
+        self.menu = menu
+        self.unknown_message = unknown_message
+        self.templates = templates
+
+def build_content_bundles() -> Dict[str, ContentBundle]:
+    """Языковые варианты из разделов languages в config.yml и auto_message.yml.
+    Команды и кнопки всех языков попадают в каждый набор: кнопка, нажатая на другом языке,
+    все равно найдется, а язык пользователя выбирает только содержимое ответа"""
+    overrides = {}
+    for source in (config, auto_messages):
+        for language, sections in (source.get("languages") or {}).items():
+            overrides.setdefault(str(language).lower(), {}).update(sections or {})
+
+    all_commands, all_buttons = {}, {}
+    for sections in overrides.values():
+        all_commands.update(sections.get("commands") or {})
+        all_buttons.update(sections.get("buttons") or {})
+
+    own_commands = config.get("commands") or {}
+    default_commands = {**all_commands, **own_commands}
+    default_buttons = {**all_buttons, **(config.get("buttons") or {})}
+    bundles = {
+        DEFAULT_LANGUAGE: ContentBundle(
+            DEFAULT_LANGUAGE, default_commands, default_buttons, own_commands,
+            config.get("unknown_message"), template_messages
+        )
+    }
+
+    for language, sections in overrides.items():
+        if language == DEFAULT_LANGUAGE:
+            continue
+        commands = sections.get("commands") or {}
+        templates = {
+            name: data for name, data in (sections.get("templates") or {}).items() if name in template_messages
+        }
+        bundles[language] = ContentBundle(
+            language,
+            {**default_commands, **commands},
+            {**default_buttons, **(sections.get("buttons") or {})},
+            {**own_commands, **commands},
+            sections.get("unknown_message", config.get("unknown_message")),
+            {**template_messages, **templates}
+        )
+    return bundles
+
+content_bundles = build_content_bundles()
+default_bundle = content_bundles[DEFAULT_LANGUAGE]
+
+def bundle_for(language_code: Optional[str]) -> ContentBundle:
+    """Набор для language_code пользователя: точное совпадение (pt-br), затем основной язык (pt)"""
+    if not language_code:
+        return default_bundle
+    language_code = language_code.lower()
+    return (content_bundles.get(language_code)
+            or content_bundles.get(language_code.split("-")[0])
+            or default_bundle)
 
 bot = Bot(
     token=config["bot"]["token"],
+    session=SHARED.get("session"),
     default=DefaultBotProperties(parse_mode="HTML")
 )
 
-DB_PATH = "users.db"
+SHUTDOWN_TIMEOUT = config.get("shutdown", {}).get("timeout", 25)
+CALLBACK_DEBOUNCE = config.get("callback_debounce", 1.0)
+
+broadcast_config = config.get("broadcast") or {}
+BROADCAST_CONCURRENCY = broadcast_config.get("concurrency", 20)
+OUTBOUND_WORKERS = broadcast_config.get("workers", 8)
+LATENCY_TARGET = broadcast_config.get("latency_target", 1.0)
+CIRCUIT_THRESHOLD = broadcast_config.get("circuit_threshold", 5)
+CIRCUIT_TIMEOUT = broadcast_config.get("circuit_timeout", 5)
+BROADCAST_RATE = broadcast_config.get("rate", 25)
+ALBUM_COLLECT_DELAY = 1.0
+PROGRESS_INTERVAL = broadcast_config.get("progress_interval", 5)
+LEASE_TTL = broadcast_config.get("lease_ttl", 300)
+DELIVERY_BATCH_SIZE = broadcast_config.get("delivery_batch_size", 500)
+SNAPSHOTS_KEEP = broadcast_config.get("snapshots_keep", 20)
+RUNS_KEEP = broadcast_config.get("runs_keep", 100)
+SNAPSHOT_SHARE_WINDOW = 60
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+def build_payments_index(payments_cfg: dict) -> Dict[str, tuple]:
+    """Индекс invoice_payload -> (название оплаты, настройки) для поиска оплаты за O(1)"""
+    index = {}
+    for name, pay_cfg in payments_cfg.items():
+        payload = pay_cfg.get("payload")
+        if not payload:
+            continue
+        if payload in index:
+            logger.warning(f"Payload '{payload}' оплаты '{name}' уже используется в '{index[payload][0]}'")
+            continue
+        index[payload] = (name, pay_cfg)
+    return index
+
+payments_config = config.get("payments") or {}
+payments_by_payload = build_payments_index(payments_config)
+
+DB_PATH = str(BOT_HOME / "users.db")
+SNAPSHOTS_DIR = BOT_HOME / "snapshots"
 
 def setup_logging():
     global log_counter
@@ -116,7 +443,8 @@ def setup_logging():
     log_counter += 1
     log_path = LOGS_DIR / log_filename
 
-    logger = logging.getLogger()
+    # Рядом с другими ботами у каждого свой логгер и файл, вывод в консоль настраивает bot_host.py
+    logger = logging.getLogger(f"bot.{BOT_NAME}" if BOT_NAME else None)
     logger.setLevel(logging.INFO)
 
     for handler in logger.handlers[:]:
@@ -136,7 +464,8 @@ def setup_logging():
     console_handler.setLevel(logging.INFO)
 
     logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    if not BOT_NAME:
+        logger.addHandler(console_handler)
 
     logging.getLogger('asyncio').setLevel(logging.WARNING)
     logging.getLogger('aiogram').setLevel(logging.INFO)
@@ -146,11 +475,46 @@ def setup_logging():
 
 logger = setup_logging()
 
+USER_PROFILE_COLUMNS = {
+    "username": "TEXT",
+    "first_name": "TEXT",
+    "last_name": "TEXT",
+    "language_code": "TEXT",
+    "first_seen": "INTEGER",
+    "last_seen": "INTEGER",
+    "payment": "TEXT",
+    "paid_at": "INTEGER",
+}
+
+DB_INDEXES = {
+    "idx_users_last_seen": "users (last_seen)",
+    "idx_users_first_seen": "users (first_seen)",
+    "idx_users_language": "users (language_code)",
+    "idx_users_payment": "users (payment, paid_at)",
+    "idx_payments_chat": "payments (chat_id, created_at)",
+    "idx_payments_payment": "payments (payment, created_at)",
+    "idx_deliveries_status": "deliveries (run_id, status, error_code)",
+}
+
+def ensure_indexes(cur: sqlite3.Cursor) -> List[str]:
+    """Создает недостающие индексы, возвращает имена созданных"""
+    existing = {row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    created = []
+    for name, target in DB_INDEXES.items():
+        if name not in existing:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+            created.append(name)
+    return created
+
 def init_users_files():
     """Инициализация базы SQLite для хранения пользователей"""
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
 
+    # Для новой базы; существующая переводится в этот режим командой /maintenance
+    cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cur.execute("PRAGMA journal_mode=WAL")
+
     cur.execute("""
                 CREATE TABLE IF NOT EXISTS users
                 (
@@ -171,51 +535,655 @@ def init_users_files():
                 )
                 """)
 
+    existing_columns = {row[1] for row in cur.execute("PRAGMA table_info(users)")}
+    for column, column_type in USER_PROFILE_COLUMNS.items():
+        if column not in existing_columns:
+            cur.execute(f"ALTER TABLE users ADD COLUMN {column} {column_type}")
+
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS payments
+                (
+                    telegram_payment_charge_id TEXT PRIMARY KEY,
+                    chat_id INTEGER NOT NULL,
+                    payment TEXT,
+                    payload TEXT,
+                    currency TEXT,
+                    amount INTEGER NOT NULL,
+                    created_at INTEGER NOT NULL,
+                    refunded_at INTEGER
+                )
+                """)
+
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS job_leases
+                (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT,
+                    expires_at INTEGER NOT NULL DEFAULT 0,
+                    last_run_at INTEGER,
+                    next_run_at INTEGER
+                )
+                """)
+
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS broadcast_runs
+                (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    source TEXT,
+                    created_at INTEGER NOT NULL
+                )
+                """)
+
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS deliveries
+                (
+                    run_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    error_code INTEGER,
+                    error TEXT,
+                    latency_ms INTEGER,
+                    message_ids TEXT,
+                    created_at INTEGER NOT NULL,
+                    PRIMARY KEY (run_id, chat_id)
+                ) WITHOUT ROWID
+                """)
+
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS media_cache
+                (
+                    file_key TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL
+                )
+                """)
+
+    cur.execute("""
+                CREATE TABLE IF NOT EXISTS bot_state
+                (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+                """)
+
+    ensure_indexes(cur)
+
     conn.commit()
     conn.close()
 
-def save_user(chat_id: int, username: str = None, first_name: str = None, last_name: str = None):
+def get_bot_state(key: str) -> Optional[str]:
+    """Служебное значение, сохраненное между запусками"""
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    cur.execute("SELECT value FROM bot_state WHERE key = ?", (key,))
+    row = cur.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def set_bot_state(key: str, value: str):
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO bot_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, value)
+    )
+    conn.commit()
+    conn.close()
+
+class UserStore:
+    """Буферизованная запись профилей пользователей: апдейты одного чата схлопываются
+    и пишутся в SQLite пачкой в отдельном потоке, не блокируя цикл событий"""
+
+    def __init__(self, flush_interval: float = 2.0):
+        self.flush_interval = flush_interval
+        self.pending: Dict[int, tuple] = {}
+        self.pending_payments: Dict[str, tuple] = {}
+        self.lock = asyncio.Lock()
+
+    def touch(self, chat_id: int, username: str = None, first_name: str = None,
+              last_name: str = None, language_code: str = None):
+        now = int(datetime.now().timestamp())
+        previous = self.pending.get(chat_id)
+        if language_code is None and previous:
+            language_code = previous[4]
+        self.pending[chat_id] = (chat_id, username, first_name, last_name, language_code, now, now)
+
+    def _write(self, rows: List[tuple]):
+        conn = sqlite3.connect(DB_PATH)
+        cur = conn.cursor()
+        cur.executemany("""
+                        INSERT INTO users (chat_id, username, first_name, last_name, language_code,
+                                           first_seen, last_seen)
+                        VALUES (?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(chat_id) DO UPDATE SET
+                            username = excluded.username,
+                            first_name = excluded.first_name,
+                            last_name = excluded.last_name,
+                            language_code = COALESCE(excluded.language_code, users.language_code),
+                            first_seen = COALESCE(users.first_seen, excluded.first_seen),
+                            last_seen = excluded.last_seen
+                        """, rows)
+        conn.commit()
+        conn.close()
+
+    async def flush(self):
+        async with self.lock:
+            await self.flush_payments()
+            if not self.pending:
+                return
+            rows = list(self.pending.values())
+            self.pending = {}
+            try:
+                await asyncio.to_thread(self._write, rows)
+            except Exception as e:
+                logger.error(f"Ошибка записи {len(rows)} пользователей: {str(e)}")
+                for row in rows:
+                    self.pending.setdefault(row[0], row)
+
+    async def flush_payments(self):
+        for charge_id, row in list(self.pending_payments.items()):
+            try:
+                await asyncio.to_thread(record_payment, *row)
+            except Exception as e:
+                logger.error(f"Платеж {charge_id} все еще не сохранен, повторим позже: {str(e)}")
+                return
+            del self.pending_payments[charge_id]
+            logger.info(f"Платеж {charge_id} сохранен после повтора")
+
+    async def run(self):
+        while not await lifecycle.sleep(self.flush_interval):
+            await self.flush()
+
+    async def record_payment(self, charge_id: str, chat_id: int, payment_name: Optional[str], payload: str,
+                             currency: str, amount: int):
+        """Платежи пишутся сразу, без буфера: запись нужна для возврата. Если база занята
+        (например, /import или VACUUM в /maintenance), платеж остается в очереди
+        и записывается при следующем flush, в том числе при остановке бота"""
+        row = (charge_id, chat_id, payment_name, payload, currency, amount, int(datetime.now().timestamp()))
+        try:
+            await asyncio.to_thread(record_payment, *row)
+        except Exception as e:
+            self.pending_payments[charge_id] = row
+            logger.error(
+                f"Не удалось сохранить платеж {charge_id} от {chat_id} ({amount} {currency}, {payload}), "
+                f"повторим позже: {str(e)}"
+            )
+
+    async def mark_refunded(self, charge_id: str):
+        await asyncio.to_thread(mark_payment_refunded, charge_id)
+
+user_store = UserStore()
+lifecycle.on_shutdown(user_store.flush)
+
+class DeliveryLog:
+    """Журнал доставки рассылок. Записи копятся в памяти и пишутся одной транзакцией
+    каждые DELIVERY_BATCH_SIZE строк (и по таймеру), не задерживая отправку"""
+
+    def __init__(self, batch_size: int = DELIVERY_BATCH_SIZE, flush_interval: float = 2.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending: List[tuple] = []
+        self.lock = asyncio.Lock()
+
+    def record(self, run_id: int, chat_id: int, status: str, error_code: Optional[int] = None,
+               error: Optional[str] = None, latency_ms: Optional[int] = None, message_ids: List[int] = None):
+        self.pending.append((
+            run_id,
+            chat_id,
+            status,
+            error_code,
+            error[:200] if error else None,
+            latency_ms,
+            ",".join(map(str, message_ids)) if message_ids else None,
+            int(datetime.now().timestamp())
+        ))
+        if len(self.pending) >= self.batch_size and not self.lock.locked():
+            lifecycle.spawn(self.flush(), name="delivery_log")
+
+    @staticmethod
+    def _write(rows: List[tuple]):
+        conn = sqlite3.connect(DB_PATH)
+        cur = conn.cursor()
+        cur.executemany("""
+                        INSERT OR REPLACE INTO deliveries
+                            (run_id, chat_id, status, error_code, error, latency_ms, message_ids, created_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        """, rows)
+        conn.commit()
+        conn.close()
+
+    async def flush(self):
+        async with self.lock:
+            while self.pending:
+                rows = self.pending[:self.batch_size]
+                del self.pending[:len(rows)]
+                try:
+                    await asyncio.to_thread(self._write, rows)
+                except Exception as e:
+                    logger.error(f"Ошибка записи журнала доставки ({len(rows)} строк): {str(e)}")
+                    self.pending[:0] = rows
+                    return
+
+    async def run(self):
+        while not await lifecycle.sleep(self.flush_interval):
+            await self.flush()
+
+delivery_log = DeliveryLog()
+lifecycle.on_shutdown(delivery_log.flush)
+
+def save_user(chat_id: int, username: str = None, first_name: str = None, last_name: str = None,
+              language_code: str = None):
     """Сохраняем пользователя, если он не заблокирован"""
     if is_user_blocked(chat_id):
         return
 
+    user_store.touch(chat_id, username, first_name, last_name, language_code)
+
+def record_payment(charge_id: str, chat_id: int, payment_name: Optional[str], payload: str,
+                   currency: str, amount: int, paid_at: Optional[int] = None):
+    """Сохраняет платеж в журнал и отмечает пользователя как оплатившего"""
+    now = paid_at or int(datetime.now().timestamp())
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    cur.execute("""
+                INSERT OR IGNORE INTO payments
+                    (telegram_payment_charge_id, chat_id, payment, payload, currency, amount, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (charge_id, chat_id, payment_name, payload, currency, amount, now))
+    if payment_name:
+        cur.execute("""
+                    INSERT INTO users (chat_id, payment, paid_at)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(chat_id) DO UPDATE SET
+                        payment = excluded.payment,
+                        paid_at = excluded.paid_at
+                    """, (chat_id, payment_name, now))
+    conn.commit()
+    conn.close()
+
+def mark_payment_refunded(charge_id: str):
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    cur.execute("UPDATE payments SET refunded_at = ? WHERE telegram_payment_charge_id = ?",
+                (int(datetime.now().timestamp()), charge_id))
+    conn.commit()
+    conn.close()
+
+def get_payment(charge_id: str) -> Optional[dict]:
+    """Платеж по telegram_payment_charge_id"""
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM payments WHERE telegram_payment_charge_id = ?", (charge_id,))
+    row = cur.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+def get_last_payment(chat_id: int) -> Optional[dict]:
+    """Последний невозвращенный платеж пользователя"""
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    cur.execute("""
+                SELECT *
+                FROM payments
+                WHERE chat_id = ? AND refunded_at IS NULL
+                ORDER BY created_at DESC
+                LIMIT 1
+                """, (chat_id,))
+    row = cur.fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+def acquire_job_lease(name: str, owner: str, ttl: int) -> Tuple[bool, int]:
+    """Берет аренду запланированной рассылки, чтобы она не запустилась дважды
+    (вторая задача той же рассылки, второй экземпляр бота или затянувшийся прошлый запуск).
+    Возвращает (получена ли аренда, когда имеет смысл попробовать снова)"""
+    now = int(datetime.now().timestamp())
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    cur = conn.cursor()
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("SELECT owner, expires_at, next_run_at FROM job_leases WHERE name = ?", (name,))
+        row = cur.fetchone()
+        if row:
+            lease_owner, expires_at, next_run_at = row
+            busy = lease_owner is not None and lease_owner != owner and expires_at > now
+            not_due = next_run_at is not None and next_run_at - now > 1
+            if busy or not_due:
+                cur.execute("ROLLBACK")
+                return False, max(expires_at if busy else 0, next_run_at or 0, now + 1)
+
+        cur.execute("""
+                    INSERT INTO job_leases (name, owner, expires_at)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(name) DO UPDATE SET
+                        owner = excluded.owner,
+                        expires_at = excluded.expires_at
+                    """, (name, owner, now + ttl))
+        cur.execute("COMMIT")
+        return True, now
+    finally:
+        conn.close()
+
+def renew_job_lease(name: str, owner: str, ttl: int):
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO users (chat_id) VALUES (?)", (chat_id,))
+    cur.execute("UPDATE job_leases SET expires_at = ? WHERE name = ? AND owner = ?",
+                (int(datetime.now().timestamp()) + ttl, name, owner))
     conn.commit()
     conn.close()
 
-def get_all_users() -> List[int]:
-    """Список всех активных пользователей (не заблокированных)"""
+def release_job_lease(name: str, owner: str, last_run_at: int, next_run_at: int):
+    """Освобождает аренду и записывает время последнего и следующего запуска"""
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    cur.execute("""
+                UPDATE job_leases
+                SET owner = NULL, expires_at = 0, last_run_at = ?, next_run_at = ?
+                WHERE name = ? AND owner = ?
+                """, (last_run_at, next_run_at, name, owner))
+    conn.commit()
+    conn.close()
+
+def create_broadcast_run(name: str, kind: str, source: Optional[dict]) -> int:
+    """Регистрирует запуск рассылки для журнала доставки, возвращает его номер.
+    Журнал хранит RUNS_KEEP последних рассылок, более старые удаляются вместе с их доставками"""
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    cur.execute("INSERT INTO broadcast_runs (name, kind, source, created_at) VALUES (?, ?, ?, ?)",
+                (name, kind, json.dumps(source, ensure_ascii=False) if source else None,
+                 int(datetime.now().timestamp())))
+    run_id = cur.lastrowid
+    if RUNS_KEEP:
+        cur.execute("DELETE FROM deliveries WHERE run_id <= ?", (run_id - RUNS_KEEP,))
+        cur.execute("DELETE FROM broadcast_runs WHERE id <= ?", (run_id - RUNS_KEEP,))
+    conn.commit()
+    conn.close()
+    return run_id
+
+def get_broadcast_run(run_id: int) -> Optional[dict]:
+    conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM broadcast_runs WHERE id = ?", (run_id,))
+    row = cur.fetchone()
+    conn.close()
+    if row is None:
+        return None
+    run = dict(row)
+    run["source"] = json.loads(run["source"]) if run["source"] else None
+    return run
+
+def get_recent_runs(limit: int = 10) -> List[tuple]:
+    """Последние рассылки: (номер, название, тип, время, доставлено, ошибок)"""
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    cur.execute("""
+                SELECT r.id, r.name, r.kind, r.created_at,
+                       (SELECT COUNT(*) FROM deliveries d WHERE d.run_id = r.id AND d.status = 'sent'),
+                       (SELECT COUNT(*) FROM deliveries d WHERE d.run_id = r.id AND d.status = 'failed')
+                FROM broadcast_runs r
+                ORDER BY r.id DESC
+                LIMIT ?
+                """, (limit,))
+    rows = cur.fetchall()
+    conn.close()
+    return rows
+
+def get_run_summary(run_id: int) -> List[tuple]:
+    """Итоги рассылки по статусам и кодам ошибок: (статус, код, количество, средняя задержка)"""
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    cur.execute("""
+                SELECT status, error_code, COUNT(*), AVG(latency_ms)
+                FROM deliveries
+                WHERE run_id = ?
+                GROUP BY status, error_code
+                ORDER BY status, error_code
+                """, (run_id,))
+    rows = cur.fetchall()
+    conn.close()
+    return rows
+
+def get_failed_recipients(run_id: int) -> List[int]:
+    """Получатели с ошибкой доставки, кроме заблокировавших бота (403)"""
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
     cur.execute("""
                 SELECT chat_id
-                FROM users
-                WHERE chat_id NOT IN (SELECT chat_id FROM blocked_users)
-                """)
+                FROM deliveries
+                WHERE run_id = ? AND status = 'failed' AND (error_code IS NULL OR error_code != 403)
+                """, (run_id,))
     rows = cur.fetchall()
     conn.close()
     return [row[0] for row in rows]
 
-def get_active_users_count() -> int:
-    """Количество активных пользователей"""
+def get_sent_messages(run_id: int) -> Dict[int, List[int]]:
+    """Отправленные сообщения рассылки по чатам"""
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
     cur.execute("""
-                SELECT COUNT(*)
-                FROM users
-                WHERE chat_id NOT IN (SELECT chat_id FROM blocked_users)
+                SELECT chat_id, message_ids
+                FROM deliveries
+                WHERE run_id = ? AND status = 'sent' AND message_ids IS NOT NULL
+                """, (run_id,))
+    rows = cur.fetchall()
+    conn.close()
+    return {chat_id: [int(message_id) for message_id in message_ids.split(",")] for chat_id, message_ids in rows}
+
+def get_revenue_stats() -> List[tuple]:
+    """Выручка по видам оплат: (оплата, количество, сумма, возвращено)"""
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    cur.execute("""
+                SELECT payment,
+                       COUNT(*),
+                       SUM(CASE WHEN refunded_at IS NULL THEN amount ELSE 0 END),
+                       SUM(refunded_at IS NOT NULL)
+                FROM payments
+                GROUP BY payment
+                ORDER BY payment
                 """)
-    count = cur.fetchone()[0]
+    rows = cur.fetchall()
     conn.close()
-    return count
+    return rows
+
+SEGMENT_HELP = "active:7d, inactive:30d, new:1d, lang:ru, paid, paid:star_payment"
+
+def parse_period(value: str) -> int:
+    """Переводит период вида 7d / 12h / 30m в секунды (без суффикса - дни)"""
+    units = {"d": 86400, "h": 3600, "m": 60}
+    value = value.strip().lower()
+    multiplier = units.get(value[-1:], None)
+    number = value[:-1] if multiplier else value
+    if not number.isdigit():
+        raise ValueError(f"Некорректный период: {value or '(пусто)'}")
+    return int(number) * (multiplier or 86400)
+
+def compile_segment(segment: Optional[str]) -> tuple:
+    """Компилирует фильтр аудитории (например "active:7d paid:star_payment")
+    в условие WHERE по индексированным полям таблицы users"""
+    clauses = ["chat_id NOT IN (SELECT chat_id FROM blocked_users)"]
+    params = []
+
+    if not segment:
+        return " AND ".join(clauses), params
+
+    now = int(datetime.now().timestamp())
+
+    for token in segment.split():
+        key, _, value = token.partition(":")
+        key = key.lower()
+
+        if key == "active":
+            clauses.append("last_seen >= ?")
+            params.append(now - parse_period(value))
+        elif key == "inactive":
+            clauses.append("(last_seen IS NULL OR last_seen < ?)")
+            params.append(now - parse_period(value))
+        elif key == "new":
+            clauses.append("first_seen >= ?")
+            params.append(now - parse_period(value))
+        elif key == "lang" and value:
+            clauses.append("language_code = ?")
+            params.append(value.lower())
+        elif key == "paid":
+            if value:
+                clauses.append("payment = ?")
+                params.append(value)
+            else:
+                clauses.append("payment IS NOT NULL")
+        else:
+            raise ValueError(f"Неизвестный фильтр аудитории: {token}")
 
-def get_total_users_count() -> int:
-    count = 0
-    if os.path.exists("users.txt"):
-        with open("users.txt", "r", encoding="utf-8") as f:
-            count = sum(1 for line in f if line.strip())
+    return " AND ".join(clauses), params
+
+def get_all_users(segment: Optional[str] = None) -> array:
+    """Все активные пользователи (не заблокированные), опционально по сегменту.
+    chat_id по возрастанию в array('q'): 8 байт на пользователя вместо объекта int в списке"""
+    where, params = compile_segment(segment)
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    cur.execute(f"SELECT chat_id FROM users WHERE {where} ORDER BY chat_id", params)
+    chat_ids = array("q")
+    while rows := cur.fetchmany(10000):
+        chat_ids.extend(row[0] for row in rows)
+    conn.close()
+    return chat_ids
+
+def get_language_users(language: str, segment: Optional[str] = None, exclude: Sequence[str] = ()) -> array:
+    """Активные пользователи с языком language и его вариантами вида language-XX, кроме вариантов
+    из exclude (у них свой набор, как в bundle_for), по возрастанию chat_id"""
+    where, params = compile_segment(segment)
+    placeholders = ", ".join("?" for _ in exclude)
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    cur.execute(
+        f"SELECT chat_id FROM users WHERE ({where}) AND (language_code = ? OR (language_code LIKE ?"
+        + (f" AND language_code NOT IN ({placeholders})" if exclude else "")
+        + ")) ORDER BY chat_id",
+        [*params, language, f"{language}-%", *exclude]
+    )
+    chat_ids = array("q")
+    while rows := cur.fetchmany(10000):
+        chat_ids.extend(row[0] for row in rows)
+    conn.close()
+    return chat_ids
+
+class RecipientSnapshot:
+    """Неизменяемый снимок получателей рассылки: chat_id по возрастанию в array('q')
+    или в отображенном в память файле (mmap). Один снимок читают несколько рассылок сразу,
+    а сохраненный в SNAPSHOTS_DIR снимок позволяет продолжить прерванную рассылку"""
+
+    def __init__(self, chat_ids: Sequence[int], segment: Optional[str] = None):
+        self.chat_ids = chat_ids
+        self.segment = segment
+        self.taken_at = monotonic()
+
+    def __len__(self) -> int:
+        return len(self.chat_ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.chat_ids)
+
+    def save(self, path: Path):
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(self.chat_ids)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "RecipientSnapshot":
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(array("q"))
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(memoryview(mapped).cast("q"))
+
+# Снимки, которые сейчас читают рассылки: одновременно запущенные рассылки на один сегмент
+# получают общий снимок, а после их завершения он освобождается
+recipient_snapshots: "weakref.WeakValueDictionary[Optional[str], RecipientSnapshot]" = weakref.WeakValueDictionary()
+
+def take_recipient_snapshot(segment: Optional[str] = None) -> RecipientSnapshot:
+    snapshot = recipient_snapshots.get(segment)
+    if snapshot is not None and monotonic() - snapshot.taken_at < SNAPSHOT_SHARE_WINDOW:
+        return snapshot
+
+    snapshot = RecipientSnapshot(get_all_users(segment), segment)
+    recipient_snapshots[segment] = snapshot
+    return snapshot
+
+def run_snapshot_path(run_id: int) -> Path:
+    return SNAPSHOTS_DIR / f"run_{run_id}.bin"
+
+def save_run_snapshot(run_id: int, snapshot: RecipientSnapshot):
+    """Сохраняет получателей рассылки, оставляя SNAPSHOTS_KEEP последних снимков"""
+    SNAPSHOTS_DIR.mkdir(exist_ok=True)
+    snapshot.save(run_snapshot_path(run_id))
+
+    saved = sorted(SNAPSHOTS_DIR.glob("run_*.bin"), key=lambda path: int(path.stem.split("_")[1]))
+    for path in saved[:-SNAPSHOTS_KEEP]:
+        path.unlink()
+
+def get_pending_recipients(run_id: int) -> Optional[Tuple[int, array]]:
+    """Получатели из снимка рассылки, которым она еще не отправлялась (прервана отменой или остановкой).
+    Снимок и журнал доставки идут по возрастанию chat_id, поэтому сравниваются за один проход.
+    Возвращает (размер снимка, ожидающие) или None, если снимок не сохранился"""
+    path = run_snapshot_path(run_id)
+    if not path.exists():
+        return None
+    snapshot = RecipientSnapshot.load(path)
+
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    cur.execute("SELECT chat_id FROM deliveries WHERE run_id = ? ORDER BY chat_id", (run_id,))
+    attempted = (row[0] for row in cur)
+    next_attempted = next(attempted, None)
+
+    pending = array("q")
+    for chat_id in snapshot:
+        while next_attempted is not None and next_attempted < chat_id:
+            next_attempted = next(attempted, None)
+        if next_attempted != chat_id:
+            pending.append(chat_id)
+    conn.close()
+    return len(snapshot), pending
+
+def get_user_profiles(from_chat_id: int, limit: int) -> Dict[int, dict]:
+    """Поля профиля для подстановки в текст рассылки ({first_name} и т.д.):
+    до limit пользователей по возрастанию chat_id, начиная с from_chat_id"""
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    cur.execute("""
+                SELECT chat_id, first_name, last_name, username
+                FROM users
+                WHERE chat_id >= ?
+                ORDER BY chat_id
+                LIMIT ?
+                """, (from_chat_id, limit))
+    profiles = {
+        chat_id: {
+            "chat_id": chat_id,
+            "first_name": first_name,
+            "last_name": last_name,
+            "full_name": " ".join(name for name in (first_name, last_name) if name),
+            "username": username,
+        }
+        for chat_id, first_name, last_name, username in cur.fetchall()
+    }
+    conn.close()
+    return profiles
+
+def get_active_users_count(segment: Optional[str] = None) -> int:
+    """Количество активных пользователей"""
+    where, params = compile_segment(segment)
+    conn = sqlite3.connect(DB_PATH)
+    cur = conn.cursor()
+    cur.execute(f"SELECT COUNT(*) FROM users WHERE {where}", params)
+    count = cur.fetchone()[0]
+    conn.close()
     return count
 
 def get_total_users_count() -> int:
@@ -262,6 +1230,208 @@ def is_user_blocked(chat_id: int) -> bool:
     conn.close()
     return result is not None
 
+TRANSFER_TABLES = {
+    "users": ("users", ["chat_id", *USER_PROFILE_COLUMNS]),
+    "blocked": ("blocked_users", ["chat_id"]),
+}
+TRANSFER_FORMATS = ("csv", "jsonl", "txt")
+IMPORT_CHUNK_SIZE = 5000
+# Боты скачивают файлы до 20 МБ и отправляют до 50 МБ, большие базы переносятся через transfer_cli
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+TRANSFER_CLI_HINT = "python telegram_bot.py export|import ..."
+
+# При импорте профиль дополняет существующий: пустые поля не затирают известные,
+# first_seen берется самый ранний, last_seen - самый поздний
+USER_IMPORT_SQL = (
+    f"INSERT INTO users (chat_id, {', '.join(USER_PROFILE_COLUMNS)}) "
+    f"VALUES ({', '.join('?' * (len(USER_PROFILE_COLUMNS) + 1))}) "
+    "ON CONFLICT(chat_id) DO UPDATE SET "
+    + ", ".join(
+        f"{column} = MIN(COALESCE(excluded.{column}, users.{column}), COALESCE(users.{column}, excluded.{column}))"
+        if column == "first_seen" else
+        f"{column} = MAX(COALESCE(excluded.{column}, users.{column}), COALESCE(users.{column}, excluded.{column}))"
+        if column == "last_seen" else
+        f"{column} = COALESCE(excluded.{column}, users.{column})"
+        for column in USER_PROFILE_COLUMNS
+    )
+)
+
+def export_table(kind: str, file_format: str, path: str) -> int:
+    """Потоково выгружает пользователей или заблокированных в CSV, JSONL или TXT (только chat_id).
+    Возвращает число строк"""
+    table, columns = TRANSFER_TABLES[kind]
+    if file_format == "txt":
+        columns = ["chat_id"]
+
+    conn = sqlite3.connect(DB_PATH)
+    count = 0
+    try:
+        rows = conn.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY chat_id")
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f) if file_format == "csv" else None
+            if writer:
+                writer.writerow(columns)
+
+            for row in rows:
+                if writer:
+                    writer.writerow(["" if value is None else value for value in row])
+                elif file_format == "jsonl":
+                    f.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+                else:
+                    f.write(f"{row[0]}\n")
+                count += 1
+    finally:
+        conn.close()
+    return count
+
+def read_import_rows(path: str, file_format: str) -> Iterator[dict]:
+    """Читает файл импорта построчно; txt - по chat_id в строке, как в старом users.txt"""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if file_format == "csv":
+            yield from csv.DictReader(f)
+            return
+
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if file_format == "jsonl":
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    yield {}
+            else:
+                yield {"chat_id": line}
+
+def import_row(row: dict, columns: List[str]) -> Optional[tuple]:
+    """Строка импорта в кортеж значений колонок или None, если ее нельзя загрузить"""
+    values = []
+    for column in columns:
+        value = row.get(column) if isinstance(row, dict) else None
+        if value == "":
+            value = None
+        if value is not None and (column == "chat_id" or USER_PROFILE_COLUMNS.get(column) == "INTEGER"):
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                return None
+        values.append(value)
+    return tuple(values) if values[0] is not None else None
+
+def import_rows(kind: str, rows: Iterable[dict]) -> Tuple[int, int]:
+    """Загружает строки пачками по IMPORT_CHUNK_SIZE, каждая пачка - отдельная транзакция.
+    Возвращает (загружено, пропущено)"""
+    table, columns = TRANSFER_TABLES[kind]
+    sql = USER_IMPORT_SQL if kind == "users" else f"INSERT OR IGNORE INTO {table} (chat_id) VALUES (?)"
+
+    loaded = 0
+    skipped = 0
+    chunk = []
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        for row in rows:
+            values = import_row(row, columns)
+            if values is None:
+                skipped += 1
+                continue
+            chunk.append(values)
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                with conn:
+                    conn.executemany(sql, chunk)
+                loaded += len(chunk)
+                chunk = []
+
+        if chunk:
+            with conn:
+                conn.executemany(sql, chunk)
+            loaded += len(chunk)
+    finally:
+        conn.close()
+    return loaded, skipped
+
+def import_file(kind: str, path: str, file_format: str) -> Tuple[int, int]:
+    return import_rows(kind, read_import_rows(path, file_format))
+
+def transfer_cli(args: List[str]) -> int:
+    """Выгрузка и загрузка пользователей через локальный файл, без ограничений Telegram на размер:
+        python telegram_bot.py export users jsonl users.jsonl
+        python telegram_bot.py import users users.jsonl"""
+    action, *args = args
+    if action == "export" and len(args) == 3 and args[0] in TRANSFER_TABLES and args[1] in TRANSFER_FORMATS:
+        kind, file_format, path = args
+        count = export_table(kind, file_format, path)
+        logger.info(f"Выгружено записей {kind}: {count} в {path}")
+        return 0
+
+    if action == "import" and len(args) == 2 and args[0] in TRANSFER_TABLES:
+        kind, path = args
+        file_format = Path(path).suffix.lstrip(".").lower()
+        if file_format in TRANSFER_FORMATS:
+            loaded, skipped = import_file(kind, path, file_format)
+            logger.info(f"Импорт {kind} из {path}: загружено {loaded}, пропущено {skipped}")
+            return 0
+
+    logger.error(
+        "Используйте: python telegram_bot.py export [users|blocked] [csv|jsonl|txt] <файл> "
+        "или python telegram_bot.py import [users|blocked] <файл.csv|.jsonl|.txt>"
+    )
+    return 2
+
+def run_db_maintenance() -> dict:
+    """ANALYZE, недостающие индексы, инкрементальная очистка и размеры таблиц"""
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        cur = conn.cursor()
+        created = ensure_indexes(cur)
+        conn.commit()
+        cur.execute("ANALYZE")
+
+        converted = False
+        if cur.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # Режим INCREMENTAL включается только полной перестройкой файла, это делается один раз
+            cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            cur.execute("VACUUM")
+            converted = True
+
+        page_size = cur.execute("PRAGMA page_size").fetchone()[0]
+        freed = cur.execute("PRAGMA freelist_count").fetchone()[0] * page_size
+        cur.execute("PRAGMA incremental_vacuum").fetchall()
+        cur.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+        try:
+            sizes = dict(cur.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name").fetchall())
+        except sqlite3.OperationalError:
+            sizes = {}
+        index_tables = dict(cur.execute("SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'").fetchall())
+
+        tables = []
+        for (table,) in cur.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        ).fetchall():
+            rows = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            index_size = sum(size for name, size in sizes.items() if index_tables.get(name) == table)
+            tables.append((table, rows, sizes.get(table), index_size))
+
+        file_size = cur.execute("PRAGMA page_count").fetchone()[0] * page_size
+    finally:
+        conn.close()
+
+    return {
+        "created_indexes": created,
+        "converted": converted,
+        "freed": freed,
+        "tables": tables,
+        "file_size": file_size,
+    }
+
+def format_size(size: int) -> str:
+    for unit in ("Б", "КБ", "МБ"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "Б" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
 async def check_user_blocked_middleware(handler: Callable[[Message, Dict[str, Any]], Awaitable[Any]],
                                         event: Message,
                                         data: Dict[str, Any]) -> Any:
@@ -275,26 +1445,122 @@ async def check_user_blocked_middleware(handler: Callable[[Message, Dict[str, An
 
 init_users_files()
 
-def format_html_description(text: str) -> str:
-    """Форматирует описание для send_invoice с поддержкой HTML-тегов"""
-    replacements = {
-        '<b>': '__B_OPEN__', '</b>': '__B_CLOSE__',
-        '<i>': '__I_OPEN__', '</i>': '__I_CLOSE__',
-        '<u>': '__U_OPEN__', '</u>': '__U_CLOSE__',
-        '<s>': '__S_OPEN__', '</s>': '__S_CLOSE__',
-        '<code>': '__CODE_OPEN__', '</code>': '__CODE_CLOSE__',
-        '<pre>': '__PRE_OPEN__', '</pre>': '__PRE_CLOSE__',
-        '<blockquote>': '__BQ_OPEN__', '</blockquote>': '__BQ_CLOSE__'
-    }
-    for original, temp in replacements.items():
-        text = text.replace(original, temp)
-
-    text = escape(text)  
+class MediaCache:
+    """Кэш file_id для локальных изображений: каждый файл загружается в Telegram один раз,
+    дальше отправляется по file_id. Ключ учитывает время изменения файла"""
+
+    def __init__(self):
+        self.file_ids: Dict[str, str] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+
+    def load(self):
+        conn = sqlite3.connect(DB_PATH)
+        cur = conn.cursor()
+        cur.execute("SELECT file_key, file_id FROM media_cache")
+        self.file_ids = dict(cur.fetchall())
+        conn.close()
+
+    @staticmethod
+    def file_key(path: str) -> str:
+        stat = os.stat(path)
+        return f"{os.path.abspath(path)}:{stat.st_mtime_ns}:{stat.st_size}"
+
+    def get(self, path: str) -> Union[str, FSInputFile]:
+        """file_id, если файл уже загружен, иначе файл для загрузки"""
+        return self.file_ids.get(self.file_key(path)) or FSInputFile(path)
+
+    async def send(self, paths: List[str], send: Callable[[List[Union[str, FSInputFile]]], Awaitable[Any]]):
+        """Отправка изображений paths: send получает их file_id или файлы в том же порядке.
+        Еще не загруженный файл загружает только первый отправитель, остальные ждут
+        его file_id под той же блокировкой, что и preload, и не загружают файл повторно"""
+        missing = sorted({path for path in paths if self.file_key(path) not in self.file_ids})
+        if missing:
+            async with AsyncExitStack() as stack:
+                for path in missing:
+                    await stack.enter_async_context(self.locks.setdefault(path, asyncio.Lock()))
+                if any(self.file_key(path) not in self.file_ids for path in missing):
+                    sent = await send([self.get(path) for path in paths])
+                    for path, message in zip(paths, sent if isinstance(sent, list) else [sent]):
+                        self.remember(path, message)
+                    return sent
+        return await send([self.get(path) for path in paths])
+
+    def remember(self, path: str, sent: Optional[Message]):
+        if not sent or not sent.photo:
+            return
+        key = self.file_key(path)
+        file_id = sent.photo[-1].file_id
+        if self.file_ids.get(key) == file_id:
+            return
+        self.file_ids[key] = file_id
+        lifecycle.spawn(asyncio.to_thread(self._save, key, file_id), name="media_cache")
+
+    @staticmethod
+    def _save(key: str, file_id: str):
+        conn = sqlite3.connect(DB_PATH)
+        cur = conn.cursor()
+        cur.execute("INSERT OR REPLACE INTO media_cache (file_key, file_id) VALUES (?, ?)", (key, file_id))
+        conn.commit()
+        conn.close()
+
+    async def upload(self, path: str, storage_chat: int):
+        lock = self.locks.setdefault(path, asyncio.Lock())
+        async with lock:
+            if self.file_key(path) in self.file_ids:
+                return
+            sent = await bot.send_photo(storage_chat, photo=FSInputFile(path), disable_notification=True)
+            self.remember(path, sent)
+            try:
+                await bot.delete_message(storage_chat, sent.message_id)
+            except Exception:
+                pass
+
+    async def preload(self, paths: List[str]):
+        """Параллельно загружает еще не закэшированные файлы в служебный чат media_cache_chat.
+        Без этого чата файл загрузится при первой отправке"""
+        storage_chat = config.get("media_cache_chat")
+        if not storage_chat:
+            return
 
-    for original, temp in replacements.items():
-        text = text.replace(temp, original)
+        missing = {path for path in paths if os.path.exists(path) and self.file_key(path) not in self.file_ids}
+        if not missing:
+            return
 
-    return text
+        results = await asyncio.gather(*(self.upload(path, storage_chat) for path in missing),
+                                       return_exceptions=True)
+        for path, result in zip(missing, results):
+            if isinstance(result, Exception):
+                logger.error(f"Не удалось предзагрузить {path}: {str(result)}")
+
+media_cache = MediaCache()
+media_cache.load()
+
+def collect_images(message_data) -> List[str]:
+    """Все локальные изображения сообщения (или списка сообщений)"""
+    parts = message_data if isinstance(message_data, list) else [message_data]
+    paths = []
+    for part in parts:
+        if not isinstance(part, dict):
+            continue
+        if part.get("image"):
+            paths.append(part["image"])
+        paths.extend(part.get("images") or [])
+    return paths
+
+FORMATTING_TAGS = "b|i|u|s|code|pre|blockquote"
+HTML_ESCAPE_PATTERN = re.compile(rf"(</?(?:{FORMATTING_TAGS})>)|[&<>]")
+HTML_QUOTE_ESCAPE_PATTERN = re.compile(rf"(</?(?:{FORMATTING_TAGS})>)|[&<>\"']")
+HTML_ESCAPES = {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"}
+
+def escape_html_keep_tags(text: str, quote: bool = False) -> str:
+    """Экранирует HTML за один проход, оставляя теги форматирования <b>, <i>, <code> и т.д."""
+    pattern = HTML_QUOTE_ESCAPE_PATTERN if quote else HTML_ESCAPE_PATTERN
+    return pattern.sub(lambda match: match.group(1) or HTML_ESCAPES[match.group(0)], text)
+
+@lru_cache(maxsize=256)
+def format_html_description(text: str) -> str:
+    """Форматирует описание для send_invoice с поддержкой HTML-тегов"""
+    return escape_html_keep_tags(text, quote=True)
 
 def get_reply_keyboard(buttons):
     if not buttons:
@@ -330,7 +1596,7 @@ def get_inline_keyboard(buttons):
         return None
 
     keyboard = []
-    payments_cfg = config.get("payments", {})
+    payments_cfg = payments_config
 
     if isinstance(buttons, list) and any(isinstance(row, list) for row in buttons):
         for row in buttons:
@@ -398,27 +1664,34 @@ async def process_pre_checkout_query(pre_checkout_query: types.PreCheckoutQuery)
 
 @dp.message(F.successful_payment)
 async def successful_payment_handler(message: types.Message):
-    payload = message.successful_payment.invoice_payload
-    payments_cfg = config.get("payments", {})
-
-    for name, pay_cfg in payments_cfg.items():
-        if pay_cfg.get("payload") == payload:
+    payment = message.successful_payment
+    name, pay_cfg = payments_by_payload.get(payment.invoice_payload, (None, None))
+
+    await user_store.record_payment(
+        payment.telegram_payment_charge_id,
+        message.from_user.id,
+        name,
+        payment.invoice_payload,
+        payment.currency,
+        payment.total_amount
+    )
 
-            await message.answer(
-                pay_cfg.get("successful_msg", "Спасибо за оплату!"),
-                reply_markup=get_inline_keyboard(pay_cfg.get("inline_buttons"))
-            )
-            break
+    if pay_cfg is not None:
+        await message.answer(
+            pay_cfg.get("successful_msg", "Спасибо за оплату!"),
+            reply_markup=get_inline_keyboard(pay_cfg.get("inline_buttons"))
+        )
 
 async def send_response(chat_id: int, data: dict):
-    payments_cfg = config.get("payments", {})
+    """Отправляет одно сообщение через очередь чата"""
+    return (await outbound.send(chat_id, [message_item(chat_id, data)]))[0]
 
-    if "backup" in data:
-        await asyncio.sleep(data["backup"])
+def message_item(chat_id: int, data: dict) -> "OutboundItem":
+    """Сообщение из конфига как элемент очереди: паузы backup и backup_print выдерживает диспетчер"""
+    return OutboundItem(lambda: deliver_message(chat_id, data), data.get("backup", 0), data.get("backup_print"))
 
-    if "backup_print" in data:
-        await bot.send_chat_action(chat_id, ChatAction.TYPING)
-        await asyncio.sleep(data["backup_print"])
+async def deliver_message(chat_id: int, data: dict):
+    payments_cfg = payments_config
 
     text = data.get("text", "").strip()
     reply_markup = None
@@ -427,7 +1700,7 @@ async def send_response(chat_id: int, data: dict):
         for btn in (data["inline_buttons"] if isinstance(data["inline_buttons"], list) else []):
             if isinstance(btn, str) and btn in payments_cfg:
                 pay_cfg = payments_cfg[btn]
-                await bot.send_invoice(
+                return await bot.send_invoice(
                     chat_id=chat_id,
                     title=pay_cfg["title"],
                     description=format_html_description(pay_cfg["description"]),
@@ -437,96 +1710,819 @@ async def send_response(chat_id: int, data: dict):
                     start_parameter="star_payment",
                     reply_markup=get_inline_keyboard([[btn]])
                 )
-                return  
 
         reply_markup = get_inline_keyboard(data["inline_buttons"])
 
     elif "reply_buttons" in data:
         reply_markup = get_reply_keyboard(data["reply_buttons"])
 
-    if "image" in data and os.path.exists(data["image"]):
-        await bot.send_photo(
+    images = [path for path in data.get("images") or [] if os.path.exists(path)]
+
+    if images:
+        return await send_album(chat_id, images, text, reply_markup)
+
+    elif "image" in data and os.path.exists(data["image"]):
+        return await media_cache.send([data["image"]], lambda photos: bot.send_photo(
             chat_id=chat_id,
-            photo=FSInputFile(data["image"]),
+            photo=photos[0],
             caption=text,
             reply_markup=reply_markup,
             parse_mode="HTML"
-        )
+        ))
 
     elif text:
-        await bot.send_message(
+        return await bot.send_message(
             chat_id=chat_id,
             text=text,
             reply_markup=reply_markup,
             parse_mode="HTML"
         )
 
-async def process_command(chat_id: int, command_data):
-    if isinstance(command_data, list):
-        for message_data in command_data:
-            await send_response(chat_id, message_data)
-    else:
-        await send_response(chat_id, command_data)
+async def send_album(chat_id: int, images: List[str], text: str = "", reply_markup=None):
+    """Отправляет изображения альбомом (sendMediaGroup, до 10 штук за вызов).
+    У альбома не может быть кнопок, поэтому при кнопках текст уходит отдельным сообщением"""
+    caption = text if reply_markup is None else ""
+    sent_messages = []
 
-async def interval_broadcast(interval: int, message_data: dict):
-    while bot_running:
-        try:
-            users = get_all_users()
-            logger.info(f"Начинаем интервальную рассылку для {len(users)} пользователей")
+    for start in range(0, len(images), 10):
+        chunk = images[start:start + 10]
 
-            for chat_id in users:
-                try:
-                    await process_command(chat_id, message_data)
-                    logger.debug(f"Сообщение отправлено в {chat_id}")
-                    await asyncio.sleep(0.1)
-                except Exception as e:
-                    logger.error(f"Ошибка отправки в {chat_id}: {str(e)}")
+        if len(chunk) == 1:
+            sent = await media_cache.send(chunk, lambda photos: bot.send_photo(
+                chat_id=chat_id,
+                photo=photos[0],
+                caption=caption if start == 0 else None,
+                parse_mode="HTML"
+            ))
+            sent_messages.append(sent)
+            continue
+
+        messages = await media_cache.send(chunk, lambda photos: bot.send_media_group(chat_id=chat_id, media=[
+            InputMediaPhoto(
+                media=photo,
+                caption=caption if start == 0 and i == 0 and caption else None,
+                parse_mode="HTML"
+            )
+            for i, photo in enumerate(photos)
+        ]))
+        sent_messages.extend(messages)
 
-            logger.info(f"Интервальная рассылка завершена. Ожидаем {interval} сек.")
-            for _ in range(interval):
-                if not bot_running:
+    if reply_markup is not None and text:
+        sent_messages.append(await bot.send_message(
+            chat_id=chat_id,
+            text=text,
+            reply_markup=reply_markup,
+            parse_mode="HTML"
+        ))
+
+    return sent_messages
+
+async def process_command(chat_id: int, command_data, bulk: bool = False) -> list:
+    """Отправляет сообщение или список сообщений по порядку через очередь чата, возвращает отправленные.
+    bulk=True для рассылок: каждая отправка проходит общий лимит частоты"""
+    parts = command_data if isinstance(command_data, list) else [command_data]
+    return await outbound.send(chat_id, [message_item(chat_id, message_data) for message_data in parts], bulk)
+
+class RateLimiter:
+    """Общий для всех рассылок лимит: не более rate отправок в секунду"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+broadcast_limiter = RateLimiter(BROADCAST_RATE)
+
+TELEGRAM_ERROR_CODES = (
+    (TelegramRetryAfter, 429),
+    (TelegramForbiddenError, 403),
+    (TelegramNotFound, 404),
+    (TelegramConflictError, 409),
+    (TelegramUnauthorizedError, 401),
+    (TelegramEntityTooLarge, 413),
+    (TelegramBadRequest, 400),
+    (TelegramServerError, 500),
+)
+
+def telegram_error_code(error: Exception) -> Optional[int]:
+    """HTTP-код ошибки Telegram API (None для сетевых и прочих ошибок)"""
+    for error_type, code in TELEGRAM_ERROR_CODES:
+        if isinstance(error, error_type):
+            return code
+    return None
+
+def sent_message_ids(result) -> List[int]:
+    """message_id из результата отправки: Message, MessageId или их списка"""
+    if isinstance(result, list):
+        return [message_id for item in result for message_id in sent_message_ids(item)]
+    message_id = getattr(result, "message_id", None)
+    return [message_id] if message_id else []
+
+class AdaptiveController:
+    """Сколько запросов к Telegram выполнять одновременно и можно ли их выполнять вообще.
+    Лимит подбирается по AIMD: растет на единицу за "окно" успешных ответов и вдвое
+    уменьшается на 429 или при задержке ответа выше latency_target.
+    После threshold ошибок 5xx/сети подряд цепь размыкается: запросы ждут timeout секунд,
+    затем проходит один пробный запрос. Успех замыкает цепь, ошибка удваивает паузу"""
+
+    SERVER_ERRORS = (TelegramServerError, TelegramNetworkError, asyncio.TimeoutError)
+
+    def __init__(self, max_limit: int, latency_target: float, threshold: int, timeout: float,
+                 max_timeout: float = 300):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.latency_target = latency_target
+        self.threshold = threshold
+        self.base_timeout = timeout
+        self.timeout = timeout
+        self.max_timeout = max_timeout
+        self.in_flight = 0
+        self.failures = 0
+        self.state = "closed"
+        self.reopen_at = 0.0
+        self.probing = False
+        self.decreased_at = 0.0
+        self.changed = asyncio.Condition()
+
+    @property
+    def retry_in(self) -> float:
+        """Через сколько секунд цепь попробует замкнуться (0, если запросы идут)"""
+        return max(0.0, self.reopen_at - monotonic()) if self.state == "open" else 0.0
+
+    def describe(self) -> str:
+        if self.state == "open":
+            return f"⚠️ Telegram API не отвечает, повтор через {format_duration(self.retry_in)}"
+        if self.state == "half-open":
+            return "⚠️ Telegram API: пробный запрос"
+        return f"🔹 Параллельных запросов: {int(self.limit)} из {self.max_limit}"
+
+    async def acquire(self):
+        async with self.changed:
+            while True:
+                if self.state == "open":
+                    if self.retry_in > 0:
+                        try:
+                            await asyncio.wait_for(self.changed.wait(), self.retry_in)
+                        except asyncio.TimeoutError:
+                            pass
+                        continue
+                    self.state = "half-open"
+                    self.probing = False
+
+                if self.state == "half-open":
+                    if not self.probing and self.in_flight == 0:
+                        self.probing = True
+                        break
+                elif self.in_flight < int(self.limit):
                     break
-                await asyncio.sleep(1)
 
+                await self.changed.wait()
+
+            self.in_flight += 1
+
+    async def release(self, latency: float, error: Optional[Exception] = None):
+        async with self.changed:
+            self.in_flight -= 1
+            self.record(latency, error)
+            self.changed.notify_all()
+
+    def decrease(self, reason: str):
+        # Одно снижение на окно latency_target, иначе пачка медленных ответов обнулит лимит
+        now = monotonic()
+        if now - self.decreased_at < self.latency_target:
+            return
+        self.decreased_at = now
+        limit = max(1.0, self.limit / 2)
+        if int(limit) != int(self.limit):
+            logger.info(f"Снижаем число параллельных запросов до {int(limit)}: {reason}")
+        self.limit = limit
+
+    def record(self, latency: float, error: Optional[Exception]):
+        if isinstance(error, self.SERVER_ERRORS):
+            self.failures += 1
+            self.decrease("ошибки сервера Telegram")
+            if self.state == "half-open":
+                self.timeout = min(self.timeout * 2, self.max_timeout)
+                self.open(error)
+            elif self.failures >= self.threshold:
+                self.open(error)
+            return
+
+        if self.state == "half-open":
+            logger.info("Telegram API снова отвечает, возобновляем отправку")
+            self.state = "closed"
+            self.timeout = self.base_timeout
+        self.failures = 0
+
+        if isinstance(error, TelegramRetryAfter):
+            self.decrease("flood-лимит Telegram")
+        elif latency > self.latency_target:
+            self.decrease(f"ответ за {latency:.1f} сек.")
+        elif self.limit < self.max_limit:
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+    def open(self, error: Exception):
+        self.state = "open"
+        self.probing = False
+        self.reopen_at = monotonic() + self.timeout
+        logger.warning(
+            f"Telegram API недоступен ({type(error).__name__}: {str(error)}), "
+            f"приостанавливаем отправку на {format_duration(self.timeout)}"
+        )
+
+# Сюда диспетчер добавляет время самих запросов к API, отправленных из текущей задачи,
+# без ожидания в очереди чата, лимите частоты и контроллере (для latency_ms журнала доставки)
+api_time: contextvars.ContextVar[Optional[List[float]]] = contextvars.ContextVar("api_time", default=None)
+
+class OutboundItem:
+    """Одна отправка в очереди чата: пауза delay, "печатает..." на typing секунд, затем вызов send()"""
+
+    __slots__ = ("send", "delay", "typing", "bulk", "batch", "attempts", "future", "timing")
+
+    def __init__(self, send: Callable[[], Awaitable[Any]], delay: float = 0, typing: Optional[float] = None):
+        self.send = send
+        self.delay = delay
+        self.typing = typing
+        self.bulk = False
+        self.batch = None
+        self.attempts = 0
+        self.future: Optional[asyncio.Future] = None
+        self.timing = api_time.get()
+
+class OutboundDispatcher:
+    """Исходящие сообщения: у каждого чата своя FIFO-очередь, обслуживает их общий пул воркеров.
+    Части одного сообщения уходят в чат строго по порядку, разные чаты отправляются параллельно.
+    Паузы backup не занимают воркер, а опустевшая очередь чата сразу удаляется,
+    поэтому память зависит только от числа чатов с неотправленными сообщениями.
+    Очередь принадлежит OutboundLane бота, так что один пул может обслуживать несколько ботов"""
+
+    def __init__(self, workers: int, controller: AdaptiveController, attempts: int = 3):
+        self.workers = workers
+        self.controller = controller
+        self.attempts = attempts
+        self.queues: Dict[Tuple["OutboundLane", int], deque] = {}
+        self.ready: Optional[asyncio.Queue] = None
+        self.tasks: Set[asyncio.Task] = set()
+        self.closing = False
+
+    def start(self):
+        """Запускает воркеры. Пул живет, пока его не остановит владелец (stop),
+        а не пока работает один из ботов, которые через него отправляют"""
+        if self.ready is not None:
+            return
+        self.ready = asyncio.Queue()
+        for number in range(self.workers):
+            task = asyncio.create_task(self.run(), name=f"outbound-{number}")
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def stop(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """Воркеры отправляют оставшееся в очередях и завершаются, по истечении timeout отменяются"""
+        self.closing = True
+        if not self.tasks:
+            return
+        _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+        if pending:
+            logger.warning(f"Отменяем {len(pending)} воркеров отправки по истечении времени")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def submit(self, lane: "OutboundLane", chat_id: int, items: List[OutboundItem],
+               bulk: bool = False) -> List[asyncio.Future]:
+        """Ставит отправки в конец очереди чата. Если одна из них упадет, остальные из этой же пачки отменяются"""
+        self.start()
+        loop = asyncio.get_running_loop()
+        batch = object()
+        for item in items:
+            item.bulk = bulk
+            item.batch = batch
+            item.future = loop.create_future()
+
+        key = (lane, chat_id)
+        queue = self.queues.get(key)
+        if queue is None:
+            self.queues[key] = deque(items)
+            self.ready.put_nowait(key)
+        else:
+            queue.extend(items)
+        return [item.future for item in items]
+
+    async def run(self):
+        while not (self.closing and not self.queues):
+            try:
+                key = await asyncio.wait_for(self.ready.get(), timeout=1)
+            except asyncio.TimeoutError:
+                continue
+            await self.process(key)
+
+    def resume_later(self, key: tuple, delay: float):
+        """Чат возвращается в очередь готовых по таймеру, воркер тем временем обслуживает другие"""
+        asyncio.get_running_loop().call_later(delay, self.ready.put_nowait, key)
+
+    def release(self, key: tuple):
+        if self.queues[key]:
+            self.ready.put_nowait(key)
+        else:
+            del self.queues[key]
+
+    def fail(self, key: tuple, error: Exception):
+        queue = self.queues[key]
+        item = queue.popleft()
+        if not item.future.done():
+            item.future.set_exception(error)
+        while queue and queue[0].batch is item.batch:
+            queue.popleft().future.cancel()
+        self.release(key)
+
+    async def process(self, key: tuple):
+        """Один шаг очереди чата: пауза, "печатает..." или сама отправка"""
+        lane, chat_id = key
+        queue = self.queues[key]
+        item = queue[0]
+
+        if item.future.done():
+            # Ожидавший результат обработчик уже отменен
+            queue.popleft()
+            self.release(key)
+            return
+
+        if item.delay:
+            delay, item.delay = item.delay, 0
+            self.resume_later(key, delay)
+            return
+
+        if item.bulk:
+            await lane.limiter.wait()
+
+        await self.controller.acquire()
+        started_at = monotonic()
+        error = None
+        sending = False
+        try:
+            if item.typing is not None:
+                await lane.bot.send_chat_action(chat_id, ChatAction.TYPING)
+                delay, item.typing = item.typing, None
+                self.resume_later(key, delay)
+                return
+            sending = True
+            result = await item.send()
+        except TelegramRetryAfter as e:
+            error = e
+            item.attempts += 1
+            if item.attempts < self.attempts:
+                lane.logger.warning(f"Flood-лимит при отправке в {chat_id}, ждем {e.retry_after} сек.")
+                self.resume_later(key, e.retry_after)
+            else:
+                self.fail(key, e)
+            return
+        except AdaptiveController.SERVER_ERRORS as e:
+            # Повтор после того, как контроллер снова пропустит запросы
+            error = e
+            item.attempts += 1
+            if item.attempts < self.attempts:
+                self.resume_later(key, item.attempts)
+            else:
+                self.fail(key, e)
+            return
         except Exception as e:
-            logger.error(f"Критическая ошибка в интервальной рассылке: {str(e)}")
-            await asyncio.sleep(60)
+            error = e
+            self.fail(key, e)
+            return
+        finally:
+            latency = monotonic() - started_at
+            if sending and item.timing is not None:
+                item.timing[0] += latency
+            await self.controller.release(latency, error)
+
+        queue.popleft()
+        if not item.future.done():
+            item.future.set_result(result)
+        self.release(key)
+
+class OutboundLane:
+    """Отправка сообщений одного бота через OutboundDispatcher: свой бот и лимит частоты рассылок,
+    общие с другими ботами процесса воркеры и контроллер нагрузки"""
+
+    def __init__(self, dispatcher: OutboundDispatcher, bot: Bot, limiter: RateLimiter):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.limiter = limiter
+        self.logger = logger
+        self.pending: Set[asyncio.Future] = set()
+
+    @property
+    def controller(self) -> AdaptiveController:
+        return self.dispatcher.controller
+
+    def submit(self, chat_id: int, items: List[OutboundItem], bulk: bool = False) -> List[asyncio.Future]:
+        futures = self.dispatcher.submit(self, chat_id, items, bulk)
+        for future in futures:
+            self.pending.add(future)
+            future.add_done_callback(self.pending.discard)
+        return futures
+
+    async def drain(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """Дожидается отправки сообщений этого бота при его остановке. Неотправленное за timeout
+        отменяется и убирается из очередей, общий пул воркеров продолжает обслуживать другие боты"""
+        if not self.pending:
+            return
+        _, pending = await asyncio.wait(set(self.pending), timeout=timeout)
+        if pending:
+            self.logger.warning(f"Отменяем {len(pending)} неотправленных сообщений по истечении времени")
+            for future in pending:
+                future.cancel()
+
+    async def send(self, chat_id: int, items: List[OutboundItem], bulk: bool = False) -> list:
+        """Отправляет пачку по порядку и возвращает результаты; ошибка первой неудачной отправки пробрасывается"""
+        if not items:
+            return []
+        return [await future for future in self.submit(chat_id, items, bulk)]
+
+if "outbound" not in SHARED:
+    SHARED["outbound"] = OutboundDispatcher(
+        OUTBOUND_WORKERS,
+        AdaptiveController(OUTBOUND_WORKERS, LATENCY_TARGET, CIRCUIT_THRESHOLD, CIRCUIT_TIMEOUT)
+    )
+outbound = OutboundLane(SHARED["outbound"], bot, broadcast_limiter)
+lifecycle.on_shutdown(outbound.drain)
+if not BOT_NAME:
+    # При запуске через bot_host.py общий пул останавливает хост, когда остановлены все боты
+    lifecycle.on_shutdown(outbound.dispatcher.stop)
+
+def queued(send: Callable[[int], Awaitable[Any]]) -> Callable[[int], Awaitable[Any]]:
+    """Отправка рассылки одному получателю через его очередь с общим лимитом частоты"""
+    async def send_queued(chat_id: int):
+        return (await outbound.send(chat_id, [OutboundItem(lambda: send(chat_id))], bulk=True))[0]
+    return send_queued
+
+async def wait_any(*events: asyncio.Event, timeout: Optional[float] = None):
+    """Ждет первое из событий (или timeout)"""
+    waiters = [asyncio.ensure_future(event.wait()) for event in events]
+    try:
+        await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+    if seconds >= 60:
+        return f"{seconds // 60} мин {seconds % 60} сек"
+    return f"{seconds} сек"
+
+class BroadcastJob:
+    """Запущенная рассылка: ее можно поставить на паузу, продолжить или отменить через /jobs"""
+
+    KINDS = {
+        "interval": "интервальная",
+        "time": "по времени",
+        "once": "однократная",
+        "msg": "/msg",
+        "retry": "повтор",
+        "delete": "удаление",
+        "resume": "продолжение",
+    }
+
+    def __init__(self, job_id: int, name: str, kind: str, source: Optional[dict] = None,
+                 run_id: Optional[int] = None):
+        self.id = job_id
+        self.name = name
+        self.kind = kind
+        self.source = source
+        self.run_id = run_id
+        self.fixed_run = run_id is not None
+        self.last_run_at: Optional[datetime] = None
+        self.task: Optional[asyncio.Task] = None
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.cancelled = asyncio.Event()
+        self.status = "ожидание"
+        self.total = 0
+        self.success = 0
+        self.failed = 0
+        self.started_at: Optional[float] = None
+
+    @property
+    def paused(self) -> bool:
+        return not self.resumed.is_set()
+
+    @property
+    def stopped(self) -> bool:
+        return self.cancelled.is_set() or not bot_running
+
+    def pause(self):
+        self.resumed.clear()
+
+    def resume(self):
+        self.resumed.set()
+
+    def cancel(self):
+        self.cancelled.set()
+        self.resumed.set()
+
+    async def sleep(self, seconds: float) -> bool:
+        """Ожидание между запусками. Возвращает True, если рассылку отменили или бот останавливается"""
+        await wait_any(self.cancelled, lifecycle.stop_event, timeout=seconds)
+        return self.stopped
+
+    async def wait_resumed(self) -> bool:
+        """Блокирует отправку на паузе. Возвращает False, если рассылку нужно прекратить"""
+        if self.paused:
+            await wait_any(self.resumed, lifecycle.stop_event)
+        return not self.stopped
+
+    async def begin_run(self, recipients: Sequence[int]):
+        """Начало прохода по получателям. Если известен источник рассылки, заводит запись
+        в журнале доставки (повтор неудачных пишет в журнал исходной рассылки)
+        и сохраняет снимок получателей, чтобы прерванную рассылку можно было продолжить"""
+        if self.source is not None and not self.fixed_run:
+            self.run_id = await asyncio.to_thread(create_broadcast_run, self.name, self.kind, self.source)
+            if isinstance(recipients, RecipientSnapshot):
+                try:
+                    await asyncio.to_thread(save_run_snapshot, self.run_id, recipients)
+                except OSError as e:
+                    logger.error(f"Не удалось сохранить снимок получателей рассылки #{self.run_id}: {str(e)}")
+        self.total = len(recipients)
+        self.success = 0
+        self.failed = 0
+        self.started_at = monotonic()
+        self.status = "рассылка"
+
+    @property
+    def done(self) -> int:
+        return self.success + self.failed
+
+    @property
+    def throughput(self) -> float:
+        if not self.started_at:
+            return 0.0
+        return self.done / max(monotonic() - self.started_at, 1e-6)
+
+    @property
+    def eta(self) -> Optional[float]:
+        rate = self.throughput
+        return (self.total - self.done) / rate if rate else None
+
+    def describe(self) -> str:
+        state = "⏸ пауза" if self.paused else self.status
+        text = f"<b>#{self.id}</b> {escape(self.name)} ({self.KINDS.get(self.kind, self.kind)}) - {state}"
+        if self.started_at and self.status == "рассылка":
+            text += f"\n    {self.done}/{self.total}, {self.throughput:.1f} сообщ./сек"
+            if self.eta is not None:
+                text += f", осталось ~{format_duration(self.eta)}"
+        elif self.last_run_at:
+            text += f"\n    последняя: {self.last_run_at:%d.%m %H:%M}"
+        return text
+
+class BroadcastJobs:
+    """Реестр запущенных рассылок"""
+
+    def __init__(self):
+        self.jobs: Dict[int, BroadcastJob] = {}
+        self.next_id = 1
+
+    def start(self, name: str, kind: str, run: Callable[[BroadcastJob], Awaitable[Any]],
+              source: Optional[dict] = None, run_id: Optional[int] = None) -> BroadcastJob:
+        job = BroadcastJob(self.next_id, name, kind, source, run_id)
+        self.next_id += 1
+        self.jobs[job.id] = job
+        job.task = lifecycle.spawn(run(job), name=f"job:{job.id}:{name}")
+        job.task.add_done_callback(lambda _: self.jobs.pop(job.id, None))
+        return job
+
+    def get(self, job_id: int) -> Optional[BroadcastJob]:
+        return self.jobs.get(job_id)
+
+broadcast_jobs = BroadcastJobs()
+
+class ProgressReporter:
+    """Обновляет сообщение с прогрессом рассылки не чаще раза в PROGRESS_INTERVAL секунд"""
+
+    def __init__(self, message: Message, title: str, job: Optional[BroadcastJob] = None,
+                 interval: float = PROGRESS_INTERVAL):
+        self.message = message
+        self.title = title
+        self.job = job
+        self.interval = interval
+        self.started_at = monotonic()
+        self.last_update = self.started_at
+
+    async def __call__(self, success: int, failed: int, total: int, force: bool = False):
+        now = monotonic()
+        if not force and now - self.last_update < self.interval:
+            return
+        self.last_update = now
+
+        done = success + failed
+        rate = done / max(now - self.started_at, 1e-6)
+        text = (
+            f"{self.title}\n"
+            f"✅ Успешно: {success}\n"
+            f"❌ Ошибок: {failed}\n"
+            f"🔹 Всего: {done}/{total}\n"
+            f"⚡ Скорость: {rate:.1f} сообщ./сек"
+        )
+        if rate and done < total:
+            text += f"\n⏱ Осталось: ~{format_duration((total - done) / rate)}"
+        if self.job:
+            text += f"\n🔸 Задача #{self.job.id}" + (" (пауза)" if self.job.paused else "")
+
+        try:
+            await self.message.edit_text(text, parse_mode="HTML")
+        except TelegramBadRequest as e:
+            logger.debug(f"Не удалось обновить прогресс рассылки: {str(e)}")
+
+async def broadcast_to_users(
+        users: Sequence[int],
+        send: Callable[[int], Awaitable[Any]],
+        on_progress: Optional[Callable[[int, int, int], Awaitable[Any]]] = None,
+        job: Optional[BroadcastJob] = None
+) -> Tuple[int, int]:
+    """Рассылка: одновременно обрабатывается до BROADCAST_CONCURRENCY получателей.
+    send(chat_id) отправляет все сообщения одному получателю через outbound (bulk=True),
+    который держит общий лимит частоты и порядок сообщений в чате. Возвращает (успешно, ошибок)"""
+    success = 0
+    failed = 0
+    recipients = iter(users)
+
+    run_id = None
+    if job:
+        await job.begin_run(users)
+        run_id = job.run_id
+
+    async def worker():
+        nonlocal success, failed
+        for chat_id in recipients:
+            if job and not await job.wait_resumed():
+                return
+            if not bot_running:
+                return
+            timing = [0.0]
+            api_time.set(timing)
+            try:
+                result = await send(chat_id)
+                success += 1
+                if run_id:
+                    delivery_log.record(run_id, chat_id, "sent",
+                                        latency_ms=int(timing[0] * 1000),
+                                        message_ids=sent_message_ids(result))
+            except Exception as e:
+                failed += 1
+                logger.error(f"Ошибка отправки в {chat_id}: {str(e)}")
+                if run_id:
+                    delivery_log.record(run_id, chat_id, "failed", telegram_error_code(e), str(e),
+                                        int(timing[0] * 1000))
+            if job:
+                job.success, job.failed = success, failed
+            if on_progress:
+                await on_progress(success, failed, len(users))
+
+    await asyncio.gather(*(worker() for _ in range(min(BROADCAST_CONCURRENCY, len(users)) or 1)))
+
+    if job:
+        job.status = "ожидание"
+
+    if success + failed < len(users):
+        reason = "отменой" if job and job.cancelled.is_set() else "остановкой бота"
+        logger.info(f"Рассылка прервана {reason}: {success + failed}/{len(users)}")
+
+    return success, failed
+
+def job_lease_owner(job: BroadcastJob) -> str:
+    """Владелец аренды - конкретная задача, а не процесс: две задачи одной рассылки
+    в одном экземпляре бота тоже не должны отправить ее дважды"""
+    return f"{INSTANCE_ID}:{job.id}"
+
+@asynccontextmanager
+async def hold_job_lease(lease_name: str, owner: str):
+    """Продлевает аренду, пока идет рассылка, чтобы ее не перехватил другой экземпляр"""
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(LEASE_TTL / 3)
+            try:
+                await asyncio.to_thread(renew_job_lease, lease_name, owner, LEASE_TTL)
+            except Exception as e:
+                logger.error(f"Не удалось продлить аренду '{lease_name}': {str(e)}")
+
+    task = asyncio.create_task(heartbeat())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+async def run_leased_broadcast(job: BroadcastJob, lease_name: str, message_data: dict,
+                               segment: Optional[str], next_run_at: Callable[[], datetime],
+                               variants: Optional[Dict[str, dict]] = None) -> Tuple[int, int]:
+    """Одна рассылка под арендой: после нее в базе остаются время запуска и следующего запуска"""
+    started_at = datetime.now()
+    try:
+        async with hold_job_lease(lease_name, job_lease_owner(job)):
+            await user_store.flush()
+            await media_cache.preload(collect_images(message_data))
+            users = take_recipient_snapshot(segment)
+            logger.info(f"Начинаем рассылку '{job.name}' для {len(users)} пользователей")
+
+            send = build_localized_sender(variants or {DEFAULT_LANGUAGE: message_data}, command_sender, segment)
+            return await broadcast_to_users(users, send, job=job)
+    finally:
+        job.last_run_at = started_at
+        await asyncio.to_thread(
+            release_job_lease,
+            lease_name,
+            job_lease_owner(job),
+            int(started_at.timestamp()),
+            int(next_run_at().timestamp())
+        )
 
-async def time_broadcast(broadcast_time: str, message_data: dict):
-    while bot_running:
+async def interval_broadcast(job: BroadcastJob, interval: int, message_data: dict,
+                             segment: Optional[str] = None, lease_name: Optional[str] = None,
+                             variants: Optional[Dict[str, dict]] = None):
+    lease_name = lease_name or f"interval:{job.name}:{segment or ''}"
+
+    while not job.stopped:
         try:
-            now = datetime.now().time()
-            target_time = time.fromisoformat(broadcast_time)
+            acquired, retry_at = await asyncio.to_thread(acquire_job_lease, lease_name, job_lease_owner(job), LEASE_TTL)
+            if not acquired:
+                wait_seconds = retry_at - datetime.now().timestamp()
+                job.status = f"следующая в {datetime.fromtimestamp(retry_at):%H:%M}"
+                logger.info(f"Рассылка '{job.name}' уже выполнялась или идет, ждем {wait_seconds:.0f} сек.")
+                if await job.sleep(wait_seconds):
+                    return
+                continue
 
-            now_datetime = datetime.now()
-            target_datetime = datetime.combine(now_datetime.date(), target_time)
+            success, failed = await run_leased_broadcast(
+                job, lease_name, message_data, segment, lambda: datetime.now() + timedelta(seconds=interval),
+                variants
+            )
+            if job.stopped:
+                return
 
-            if now > target_time:
-                target_datetime = target_datetime.replace(day=target_datetime.day + 1)
+            logger.info(
+                f"Интервальная рассылка завершена (успешно: {success}, ошибок: {failed}). Ожидаем {interval} сек."
+            )
+            job.status = f"следующая через {format_duration(interval)}"
+            if await job.sleep(interval):
+                return
 
-            wait_seconds = (target_datetime - now_datetime).total_seconds()
+        except Exception as e:
+            logger.error(f"Критическая ошибка в интервальной рассылке: {str(e)}")
+            if await job.sleep(60):
+                return
+
+def next_daily_run(broadcast_time: str, after: Optional[datetime] = None) -> datetime:
+    """Ближайшее наступление времени HH:MM после after"""
+    after = after or datetime.now()
+    target_datetime = datetime.combine(after.date(), time.fromisoformat(broadcast_time))
+    if target_datetime <= after:
+        target_datetime += timedelta(days=1)
+    return target_datetime
+
+async def time_broadcast(job: BroadcastJob, broadcast_time: str, message_data: dict,
+                         segment: Optional[str] = None, lease_name: Optional[str] = None,
+                         variants: Optional[Dict[str, dict]] = None):
+    lease_name = lease_name or f"time:{job.name}:{segment or ''}"
+
+    while not job.stopped:
+        try:
+            target_datetime = next_daily_run(broadcast_time)
+            wait_seconds = (target_datetime - datetime.now()).total_seconds()
             logger.info(f"Следующая рассылка в {broadcast_time} через {wait_seconds:.0f} секунд")
 
-            for _ in range(int(wait_seconds)):
-                if not bot_running:
-                    return
-                await asyncio.sleep(1)
+            job.status = f"следующая в {broadcast_time}"
+            if await job.sleep(wait_seconds):
+                return
 
-            users = get_all_users()
-            logger.info(f"Начинаем рассылку в {broadcast_time} для {len(users)} пользователей")
+            acquired, _ = await asyncio.to_thread(acquire_job_lease, lease_name, job_lease_owner(job), LEASE_TTL)
+            if not acquired:
+                logger.info(f"Рассылка '{job.name}' в {broadcast_time} уже выполнена другим экземпляром, пропускаем")
+                await job.sleep(1)
+                continue
 
-            for chat_id in users:
-                try:
-                    await process_command(chat_id, message_data)
-                    await asyncio.sleep(0.1)
-                except Exception as e:
-                    logger.error(f"Ошибка отправки в {chat_id}: {str(e)}")
+            success, failed = await run_leased_broadcast(
+                job, lease_name, message_data, segment,
+                lambda: next_daily_run(broadcast_time, target_datetime), variants
+            )
+            if job.stopped:
+                return
 
-            logger.info(f"Рассылка в {broadcast_time} завершена")
+            logger.info(f"Рассылка в {broadcast_time} завершена (успешно: {success}, ошибок: {failed})")
 
         except Exception as e:
             logger.error(f"Критическая ошибка во временной рассылке: {str(e)}")
-            await asyncio.sleep(60)
+            if await job.sleep(60):
+                return
 
 async def setup_broadcasts():
     if not scheduled_messages:
@@ -536,15 +2532,25 @@ async def setup_broadcasts():
     for message_name, message_config in scheduled_messages.items():
         try:
             if "interval" in message_config:
-                asyncio.create_task(
-                    interval_broadcast(message_config["interval"], message_config["message"])
+                broadcast_jobs.start(
+                    message_name,
+                    "interval",
+                    lambda job, name=message_name, cfg=message_config: interval_broadcast(
+                        job, cfg["interval"], cfg["message"], cfg.get("segment"), f"scheduled:{name}"
+                    ),
+                    source={"type": "scheduled", "name": message_name}
                 )
                 logger.info(
                     f"Запущена интервальная рассылка '{message_name}' каждые {message_config['interval']} секунд")
 
             elif "time" in message_config:
-                asyncio.create_task(
-                    time_broadcast(message_config["time"], message_config["message"])
+                broadcast_jobs.start(
+                    message_name,
+                    "time",
+                    lambda job, name=message_name, cfg=message_config: time_broadcast(
+                        job, cfg["time"], cfg["message"], cfg.get("segment"), f"scheduled:{name}"
+                    ),
+                    source={"type": "scheduled", "name": message_name}
                 )
                 logger.info(f"Запущена временная рассылка '{message_name}' в {message_config['time']}")
 
@@ -560,7 +2566,7 @@ async def cmd_template_message(message: types.Message):
         await message.answer("⛔ У вас нет прав для этой команды")
         return
 
-    args = message.text.split(maxsplit=1)
+    args = message.text.split(maxsplit=2)
     if len(args) < 2:
         if not template_messages:
             await message.answer("ℹ️ Нет доступных шаблонов сообщений")
@@ -570,7 +2576,8 @@ async def cmd_template_message(message: types.Message):
         await message.answer(
             "📝 Доступные шаблоны сообщений:\n"
             f"{templates_list}\n\n"
-            "Используйте: <code>/m название_шаблона</code>",
+            "Используйте: <code>/m название_шаблона [сегмент]</code>\n"
+            f"Сегменты: <code>{SEGMENT_HELP}</code>",
             parse_mode="HTML"
         )
         return
@@ -596,11 +2603,25 @@ async def cmd_template_message(message: types.Message):
         message_data = template_data
         info_text = "🔹 Однократная рассылка"
 
-    users = get_all_users()
-    total_users = len(users)
+    segment = args[2].strip() if len(args) > 2 else template_data.get("segment", "")
+    confirm_data = f"broadcast_confirm:{template_name}:{segment}"
+
+    if len(confirm_data.encode("utf-8")) > 64:
+        await message.answer("❌ Слишком длинное название шаблона или сегмента")
+        return
+
+    try:
+        await user_store.flush()
+        total_users = get_active_users_count(segment)
+    except ValueError as e:
+        await message.answer(f"❌ {escape(str(e))}\nДоступные сегменты: <code>{SEGMENT_HELP}</code>")
+        return
+
+    if segment:
+        info_text += f"\n🔹 Сегмент: <code>{escape(segment)}</code>"
 
     confirm_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="✅ Начать рассылку", callback_data=f"broadcast_confirm:{template_name}")],
+        [InlineKeyboardButton(text="✅ Начать рассылку", callback_data=confirm_data)],
         [InlineKeyboardButton(text="❌ Отменить", callback_data="broadcast_cancel")]
     ])
 
@@ -620,7 +2641,8 @@ async def cmd_template_message(message: types.Message):
 
 @dp.callback_query(F.data.startswith("broadcast_confirm:"))
 async def confirm_broadcast(callback: types.CallbackQuery):
-    template_name = callback.data.split(":")[1]
+    _, template_name, segment = (callback.data.split(":", 2) + [""])[:3]
+    segment = segment or None
 
     if template_name not in template_messages:
         await callback.answer("❌ Шаблон больше не существует")
@@ -634,121 +2656,467 @@ async def confirm_broadcast(callback: types.CallbackQuery):
 
         if "interval" in broadcast_config:
 
-            asyncio.create_task(interval_broadcast(broadcast_config["interval"], message_data))
+            job = broadcast_jobs.start(
+                template_name,
+                "interval",
+                lambda job: interval_broadcast(
+                    job, broadcast_config["interval"], message_data, segment,
+                    variants=template_variants(template_name)
+                ),
+                source={"type": "template_command", "name": template_name}
+            )
             await callback.message.edit_text(
                 f"🔄 Запущена интервальная рассылка шаблона '<b>{template_name}</b>'\n"
-                f"🔹 Интервал: каждые {broadcast_config['interval']} секунд",
+                f"🔹 Интервал: каждые {broadcast_config['interval']} секунд\n"
+                f"🔸 Задача #{job.id}, управление: /jobs",
                 parse_mode="HTML"
             )
         elif "time" in broadcast_config:
 
-            asyncio.create_task(time_broadcast(broadcast_config["time"], message_data))
+            job = broadcast_jobs.start(
+                template_name,
+                "time",
+                lambda job: time_broadcast(
+                    job, broadcast_config["time"], message_data, segment,
+                    variants=template_variants(template_name)
+                ),
+                source={"type": "template_command", "name": template_name}
+            )
             await callback.message.edit_text(
                 f"🕒 Запущена временная рассылка шаблона '<b>{template_name}</b>'\n"
-                f"🔹 Время рассылки: {broadcast_config['time']}",
+                f"🔹 Время рассылки: {broadcast_config['time']}\n"
+                f"🔸 Задача #{job.id}, управление: /jobs",
                 parse_mode="HTML"
             )
         else:
 
-            await send_template_to_all_users(template_name, message_data, callback.message)
+            broadcast_jobs.start(
+                template_name,
+                "once",
+                lambda job: send_template_to_all_users(template_name, message_data, callback.message, segment, job),
+                source={"type": "template", "name": template_name, "segment": segment}
+            )
     else:
 
-        await send_template_to_all_users(template_name, template_data, callback.message)
+        broadcast_jobs.start(
+            template_name,
+            "once",
+            lambda job: send_template_to_all_users(template_name, template_data, callback.message, segment, job),
+            source={"type": "template", "name": template_name, "segment": segment}
+        )
 
     await callback.answer()
 
-async def prepare_message_data(message_data: dict) -> dict:
-    """Подготавливает данные сообщения, идентично scheduled рассылкам"""
+PLACEHOLDER_PATTERN = re.compile(r"\{(first_name|last_name|full_name|username|chat_id)(?:\|([^{}]*))?\}")
 
-    prepared_data = message_data.copy()
+class MessageTemplate:
+    """Текст рассылки, экранированный один раз. Подстановки вида {first_name} или
+    {first_name|друг} (со значением по умолчанию) заполняются при render простым join"""
 
-    if 'text' in prepared_data:
-        text = prepared_data['text']
-
-        replacements = {
-            '<b>': '__TAG_B_OPEN__', '</b>': '__TAG_B_CLOSE__',
-            '<i>': '__TAG_I_OPEN__', '</i>': '__TAG_I_CLOSE__',
-            '<u>': '__TAG_U_OPEN__', '</u>': '__TAG_U_CLOSE__',
-            '<s>': '__TAG_S_OPEN__', '</s>': '__TAG_S_CLOSE__',
-            '<code>': '__TAG_CODE_OPEN__', '</code>': '__TAG_CODE_CLOSE__',
-            '<pre>': '__TAG_PRE_OPEN__', '</pre>': '__TAG_PRE_CLOSE__',
-            '<blockquote>': '__TAG_BQ_OPEN__', '</blockquote>': '__TAG_BQ_CLOSE__'
-        }
+    def __init__(self, text: str):
+        parts = PLACEHOLDER_PATTERN.split(escape_html_keep_tags(text))
+        self.literals = parts[0::3]
+        self.fields = list(zip(parts[1::3], [default or "" for default in parts[2::3]]))
 
-        for original, temp in replacements.items():
-            text = text.replace(original, temp)
+    @property
+    def personalized(self) -> bool:
+        return bool(self.fields)
 
-        text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    def render(self, user: Optional[dict] = None) -> str:
+        if not self.fields:
+            return self.literals[0]
 
-        for original, temp in replacements.items():
-            text = text.replace(temp, original)
+        chunks = [self.literals[0]]
+        for (field, default), literal in zip(self.fields, self.literals[1:]):
+            value = user.get(field) if user else None
+            chunks.append(escape(str(value), quote=False) if value else default)
+            chunks.append(literal)
+        return "".join(chunks)
 
-        prepared_data['text'] = text
-        prepared_data['parse_mode'] = 'HTML'
+def prepare_message_data(message_data: dict) -> dict:
+    """Один раз на рассылку готовит шаблон текста и клавиатуру, идентично scheduled рассылкам"""
+
+    prepared_data = message_data.copy()
+    prepared_data['template'] = MessageTemplate(prepared_data.get('text') or '')
+    prepared_data['reply_markup'] = (get_reply_keyboard(prepared_data.get('reply_buttons')) or
+                                     get_inline_keyboard(prepared_data.get('inline_buttons')))
+    prepared_data['parse_mode'] = 'HTML'
 
     return prepared_data
 
-async def send_template_to_all_users(template_name: str, message_data: dict, message: types.Message):
-    """Отправляет шаблон всем пользователям, идентично scheduled"""
-    users = get_all_users()
-    total_users = len(users)
+PROFILE_CHUNK_SIZE = 1000
 
-    await message.edit_text(f"⏳ Начинаю рассылку шаблона '<b>{template_name}</b>'...", parse_mode="HTML")
+class ProfileLookup:
+    """Профили получателей рассылки для подстановок. Снимок получателей идет по возрастанию
+    chat_id, поэтому профили читаются из базы кусками по PROFILE_CHUNK_SIZE начиная
+    с запрошенного, а в памяти держатся только последние keep кусков"""
 
-    success = 0
-    failed = 0
+    def __init__(self, keep: int = 4):
+        self.chunks: deque = deque(maxlen=keep)
+        self.lock = asyncio.Lock()
 
-    for i, chat_id in enumerate(users, 1):
-        try:
+    def find(self, chat_id: int) -> Optional[tuple]:
+        for chunk in self.chunks:
+            if chunk[0] <= chat_id <= chunk[1]:
+                return chunk
+        return None
 
-            prepared_data = await prepare_message_data(message_data)
+    async def get(self, chat_id: int) -> Optional[dict]:
+        chunk = self.find(chat_id)
+        if chunk is None:
+            async with self.lock:
+                chunk = self.find(chat_id)
+                if chunk is None:
+                    profiles = await asyncio.to_thread(get_user_profiles, chat_id, PROFILE_CHUNK_SIZE)
+                    # Неполный кусок - дальше в базе никого нет
+                    last = max(profiles) if len(profiles) == PROFILE_CHUNK_SIZE else float("inf")
+                    chunk = (chat_id, last, profiles)
+                    self.chunks.append(chunk)
+        return chunk[2].get(chat_id)
+
+def build_template_sender(message_data: dict) -> Callable[[int], Awaitable[Any]]:
+    """Отправка заранее подготовленного шаблона одному получателю"""
+    prepared_data = prepare_message_data(message_data)
+    template = prepared_data['template']
+    reply_markup = prepared_data['reply_markup']
+    images = [path for path in prepared_data.get('images') or [] if os.path.exists(path)]
+    image = prepared_data.get('image') if prepared_data.get('image') and os.path.exists(prepared_data['image']) else None
+    profiles = ProfileLookup() if template.personalized else None
+
+    async def send_template(chat_id: int):
+        text = template.render(await profiles.get(chat_id) if profiles else None)
+
+        if images:
+            return await send_album(chat_id, images, text, reply_markup)
+        elif image:
+            return await media_cache.send([image], lambda photos: bot.send_photo(
+                chat_id=chat_id,
+                photo=photos[0],
+                caption=text,
+                reply_markup=reply_markup
+            ))
+        elif text:
+            return await bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                reply_markup=reply_markup,
+                parse_mode='HTML'
+            )
 
-            if 'image' in prepared_data and os.path.exists(prepared_data['image']):
-                media = InputMediaPhoto(
-                    media=FSInputFile(prepared_data['image']),
-                    caption=prepared_data.get('text', ''),
-                    parse_mode='HTML'
-                )
-                await bot.send_photo(
-                    chat_id=chat_id,
-                    photo=media.media,
-                    caption=media.caption,
-                    reply_markup=get_reply_keyboard(prepared_data.get('reply_buttons')) or
-                                 get_inline_keyboard(prepared_data.get('inline_buttons'))
-                )
-            elif prepared_data.get('text'):
-                await bot.send_message(
-                    chat_id=chat_id,
-                    text=prepared_data['text'],
-                    reply_markup=get_reply_keyboard(prepared_data.get('reply_buttons')) or
-                                 get_inline_keyboard(prepared_data.get('inline_buttons')),
-                    parse_mode='HTML'
-                )
+    return queued(send_template)
+
+def resolve_template_message(template_name: str, bundle: Optional[ContentBundle] = None) -> Optional[dict]:
+    """Сообщение шаблона из auto_message.yml, как его отправляет confirm_broadcast"""
+    template_data = (bundle or default_bundle).templates.get(template_name)
+    if template_data is None:
+        return None
+    if "broadcast" in template_data and "message" in template_data:
+        return template_data["message"]
+    return template_data
+
+def template_variants(template_name: str) -> Dict[str, dict]:
+    """Сообщение шаблона по языкам: язык по умолчанию и те, где шаблон переопределен"""
+    default_message = resolve_template_message(template_name)
+    variants = {DEFAULT_LANGUAGE: default_message}
+    for language, bundle in content_bundles.items():
+        message_data = resolve_template_message(template_name, bundle)
+        if message_data is not None and message_data is not default_message:
+            variants[language] = message_data
+    return variants
+
+def command_sender(message_data: dict) -> Callable[[int], Awaitable[Any]]:
+    return lambda chat_id: process_command(chat_id, message_data, bulk=True)
+
+def build_localized_sender(variants: Dict[str, dict], build: Callable[[dict], Callable[[int], Awaitable[Any]]],
+                           segment: Optional[str] = None) -> Callable[[int], Awaitable[Any]]:
+    """Отправка на языке получателя: build вызывается один раз на язык, а получатели каждого
+    языка выбираются из базы одним запросом и ищутся в отсортированном массиве двоичным поиском.
+    Язык получателя определяется как в bundle_for: pt-br относится к набору pt-br, если он есть,
+    и только иначе к pt. Остальные получают вариант языка по умолчанию"""
+    default_send = build(variants[DEFAULT_LANGUAGE])
+    groups = []
+    for language, message_data in variants.items():
+        if language == DEFAULT_LANGUAGE:
+            continue
+        own_variants = [code for code in content_bundles if code.startswith(f"{language}-")]
+        chat_ids = get_language_users(language, segment, own_variants)
+        if chat_ids:
+            groups.append((chat_ids, build(message_data)))
+            logger.info(f"Вариант на языке {language}: {len(chat_ids)} получателей")
+
+    if not groups:
+        return default_send
+
+    async def send(chat_id: int):
+        for chat_ids, language_send in groups:
+            position = bisect_left(chat_ids, chat_id)
+            if position < len(chat_ids) and chat_ids[position] == chat_id:
+                return await language_send(chat_id)
+        return await default_send(chat_id)
+
+    return send
+
+async def send_template_to_all_users(template_name: str, message_data: dict, message: types.Message,
+                                     segment: Optional[str] = None, job: Optional[BroadcastJob] = None):
+    """Отправляет шаблон всем пользователям (или сегменту), идентично scheduled"""
+    variants = {**template_variants(template_name), DEFAULT_LANGUAGE: message_data}
+    await user_store.flush()
+    await media_cache.preload([path for data in variants.values() for path in collect_images(data)])
+    users = take_recipient_snapshot(segment)
+    total_users = len(users)
 
-            success += 1
+    await message.edit_text(f"⏳ Начинаю рассылку шаблона '<b>{template_name}</b>'...", parse_mode="HTML")
 
-            if i % 10 == 0:
-                await message.edit_text(
-                    f"📨 Рассылка шаблона '<b>{template_name}</b>'\n"
-                    f"✅ Успешно: {success}\n"
-                    f"❌ Ошибок: {failed}\n"
-                    f"🔹 Всего: {i}/{total_users}",
-                    parse_mode="HTML"
-                )
+    send_template = build_localized_sender(variants, build_template_sender, segment)
 
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            failed += 1
-            logger.error(f"Ошибка отправки в {chat_id}: {str(e)}")
+    report_progress = ProgressReporter(message, f"📨 Рассылка шаблона '<b>{template_name}</b>'", job)
+    success, failed = await broadcast_to_users(users, send_template, report_progress, job)
 
+    status = "отменена" if job and job.cancelled.is_set() else "завершена"
     await message.edit_text(
-        f"✅ Рассылка шаблона '<b>{template_name}</b>' завершена:\n"
+        f"✅ Рассылка шаблона '<b>{template_name}</b>' {status}:\n"
         f"• Успешно: {success}\n"
         f"• Не удалось: {failed}\n"
         f"• Всего: {total_users}",
         parse_mode="HTML"
     )
 
+def jobs_overview() -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    if not broadcast_jobs.jobs:
+        return f"ℹ️ Нет запущенных рассылок\n\n{outbound.controller.describe()}", None
+
+    lines = [job.describe() for job in broadcast_jobs.jobs.values()]
+    keyboard = [
+        [
+            InlineKeyboardButton(
+                text=f"▶️ #{job.id}" if job.paused else f"⏸ #{job.id}",
+                callback_data=f"job:{'resume' if job.paused else 'pause'}:{job.id}"
+            ),
+            InlineKeyboardButton(text=f"✖️ #{job.id}", callback_data=f"job:cancel:{job.id}")
+        ]
+        for job in broadcast_jobs.jobs.values()
+    ]
+    keyboard.append([InlineKeyboardButton(text="🔄 Обновить", callback_data="job:refresh:0")])
+
+    lines.append(outbound.controller.describe())
+    return "📋 Рассылки:\n\n" + "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+def apply_job_action(action: str, job_id: int) -> str:
+    job = broadcast_jobs.get(job_id)
+    if job is None:
+        return f"❌ Рассылка #{job_id} не найдена"
+
+    if action == "pause":
+        job.pause()
+        return f"⏸ Рассылка #{job_id} на паузе"
+    if action == "resume":
+        job.resume()
+        return f"▶️ Рассылка #{job_id} продолжена"
+    if action == "cancel":
+        job.cancel()
+        return f"✖️ Рассылка #{job_id} отменена"
+
+    return "❌ Неизвестное действие"
+
+@dp.message(Command("jobs"))
+async def cmd_jobs(message: types.Message, command: CommandObject):
+    if not (config.get("admin_ids") and message.from_user.id in config["admin_ids"]):
+        await message.answer("⛔ У вас нет прав для этой команды")
+        return
+
+    args = (command.args or "").split()
+    if args:
+        if len(args) != 2 or not args[1].isdigit():
+            await message.answer("Используйте: /jobs [pause|resume|cancel номер]")
+            return
+        await message.answer(apply_job_action(args[0].lower(), int(args[1])))
+        return
+
+    text, keyboard = jobs_overview()
+    await message.answer(text, reply_markup=keyboard, parse_mode="HTML")
+
+@dp.callback_query(F.data.startswith("job:"))
+async def job_control(callback: types.CallbackQuery):
+    if not (config.get("admin_ids") and callback.from_user.id in config["admin_ids"]):
+        await callback.answer("⛔ У вас нет прав для этой команды")
+        return
+
+    _, action, job_id = callback.data.split(":", 2)
+    if action != "refresh":
+        await callback.answer(apply_job_action(action, int(job_id)))
+    else:
+        await callback.answer()
+
+    text, keyboard = jobs_overview()
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard, parse_mode="HTML")
+    except TelegramBadRequest:
+        pass
+
+async def retry_failed_deliveries(job: BroadcastJob, run: dict, message: Message):
+    """Повторная отправка получателям, которым рассылка не дошла"""
+    await delivery_log.flush()
+    sender = build_run_sender(run["source"])
+    if sender is None:
+        await message.answer(f"❌ Рассылку #{run['id']} нельзя повторить: исходное сообщение не найдено")
+        return
+
+    recipients = await asyncio.to_thread(get_failed_recipients, run["id"])
+    progress_msg = await message.answer(f"🔁 Повторяем рассылку #{run['id']} для {len(recipients)} получателей...")
+
+    report_progress = ProgressReporter(progress_msg, f"🔁 Повтор рассылки #{run['id']}", job)
+    success, failed = await broadcast_to_users(recipients, sender, report_progress, job)
+
+    await progress_msg.edit_text(
+        f"✅ Повтор рассылки #{run['id']} завершен:\n"
+        f"• Успешно: {success}\n"
+        f"• Не удалось: {failed}"
+    )
+
+async def resume_broadcast(job: BroadcastJob, run: dict, message: Message):
+    """Продолжает прерванную рассылку для получателей из ее снимка, которым она не отправлялась"""
+    await delivery_log.flush()
+    sender = build_run_sender(run["source"])
+    progress = await asyncio.to_thread(get_pending_recipients, run["id"])
+    if sender is None or progress is None:
+        await message.answer(f"❌ Рассылку #{run['id']} нельзя продолжить: нет исходного сообщения или снимка получателей")
+        return
+
+    _, recipients = progress
+    progress_msg = await message.answer(f"▶️ Продолжаем рассылку #{run['id']} для {len(recipients)} получателей...")
+
+    report_progress = ProgressReporter(progress_msg, f"▶️ Продолжение рассылки #{run['id']}", job)
+    success, failed = await broadcast_to_users(recipients, sender, report_progress, job)
+
+    await progress_msg.edit_text(
+        f"✅ Продолжение рассылки #{run['id']} завершено:\n"
+        f"• Успешно: {success}\n"
+        f"• Не удалось: {failed}"
+    )
+
+async def delete_sent_messages(job: BroadcastJob, run: dict, message: Message):
+    """Удаляет у получателей сообщения, отправленные рассылкой"""
+    await delivery_log.flush()
+    sent_messages = await asyncio.to_thread(get_sent_messages, run["id"])
+    progress_msg = await message.answer(f"🗑 Удаляем рассылку #{run['id']} у {len(sent_messages)} получателей...")
+
+    async def delete(chat_id: int):
+        message_ids = sent_messages[chat_id]
+        await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+        delivery_log.record(run["id"], chat_id, "deleted", message_ids=message_ids)
+
+    report_progress = ProgressReporter(progress_msg, f"🗑 Удаление рассылки #{run['id']}", job)
+    success, failed = await broadcast_to_users(list(sent_messages), queued(delete), report_progress, job)
+    await delivery_log.flush()
+
+    await progress_msg.edit_text(
+        f"✅ Удаление рассылки #{run['id']} завершено:\n"
+        f"• Удалено: {success}\n"
+        f"• Не удалось: {failed}"
+    )
+
+@dp.message(Command("deliveries"))
+async def cmd_deliveries(message: types.Message, command: CommandObject):
+    if not (config.get("admin_ids") and message.from_user.id in config["admin_ids"]):
+        await message.answer("⛔ У вас нет прав для этой команды")
+        return
+
+    await delivery_log.flush()
+    args = (command.args or "").strip()
+
+    if not args:
+        runs = await asyncio.to_thread(get_recent_runs)
+        if not runs:
+            await message.answer("ℹ️ Журнал рассылок пуст")
+            return
+
+        lines = [
+            f"<b>#{run_id}</b> {escape(name)} ({BroadcastJob.KINDS.get(kind, kind)}) "
+            f"{datetime.fromtimestamp(created_at):%d.%m %H:%M} - ✅ {sent} ❌ {failed}"
+            for run_id, name, kind, created_at, sent, failed in runs
+        ]
+        await message.answer(
+            "📬 Последние рассылки:\n\n" + "\n".join(lines) + "\n\nПодробнее: <code>/deliveries номер</code>",
+            parse_mode="HTML"
+        )
+        return
+
+    if not args.isdigit():
+        await message.answer("Используйте: /deliveries [номер_рассылки]")
+        return
+
+    run = await asyncio.to_thread(get_broadcast_run, int(args))
+    if run is None:
+        await message.answer(f"❌ Рассылка #{args} не найдена")
+        return
+
+    statuses = {"sent": "✅ Доставлено", "failed": "❌ Ошибка", "deleted": "🗑 Удалено"}
+    summary = await asyncio.to_thread(get_run_summary, run["id"])
+    lines = [
+        f"{statuses.get(status, status)}"
+        + (f" (код {error_code})" if error_code else "")
+        + f": {count}, ответ Telegram в среднем {avg_latency or 0:.0f} мс"
+        for status, error_code, count, avg_latency in summary
+    ]
+
+    buttons = [
+        [
+            InlineKeyboardButton(text="🔁 Повторить неудачные", callback_data=f"deliveries:retry:{run['id']}"),
+            InlineKeyboardButton(text="🗑 Удалить отправленные", callback_data=f"deliveries:delete:{run['id']}")
+        ]
+    ]
+
+    progress = await asyncio.to_thread(get_pending_recipients, run["id"])
+    if progress is not None:
+        total, pending = progress
+        lines.append(f"👥 Получателей в снимке: {total}, не обработано: {len(pending)}")
+        if pending and not any(job.run_id == run["id"] for job in broadcast_jobs.jobs.values()):
+            buttons.append([
+                InlineKeyboardButton(text="▶️ Продолжить рассылку", callback_data=f"deliveries:resume:{run['id']}")
+            ])
+
+    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+
+    await message.answer(
+        f"📬 Рассылка <b>#{run['id']}</b> {escape(run['name'])} "
+        f"({datetime.fromtimestamp(run['created_at']):%d.%m.%Y %H:%M})\n\n"
+        + ("\n".join(lines) or "Нет записей о доставке"),
+        reply_markup=keyboard,
+        parse_mode="HTML"
+    )
+
+@dp.callback_query(F.data.startswith("deliveries:"))
+async def deliveries_action(callback: types.CallbackQuery):
+    if not (config.get("admin_ids") and callback.from_user.id in config["admin_ids"]):
+        await callback.answer("⛔ У вас нет прав для этой команды")
+        return
+
+    _, action, run_id = callback.data.split(":", 2)
+    run = await asyncio.to_thread(get_broadcast_run, int(run_id))
+    if run is None:
+        await callback.answer("❌ Рассылка не найдена")
+        return
+
+    if action == "retry":
+        job = broadcast_jobs.start(
+            f"повтор #{run['id']}", "retry",
+            lambda job: retry_failed_deliveries(job, run, callback.message),
+            run_id=run["id"]
+        )
+    elif action == "resume":
+        job = broadcast_jobs.start(
+            f"продолжение #{run['id']}", "resume",
+            lambda job: resume_broadcast(job, run, callback.message),
+            run_id=run["id"]
+        )
+    else:
+        job = broadcast_jobs.start(
+            f"удаление #{run['id']}", "delete",
+            lambda job: delete_sent_messages(job, run, callback.message)
+        )
+
+    await callback.answer(f"Запущена задача #{job.id}")
+
 @dp.callback_query(F.data == "broadcast_cancel")
 async def cancel_broadcast(callback: types.CallbackQuery):
     await callback.message.edit_text("❌ Рассылка отменена")
@@ -764,18 +3132,44 @@ async def cmd_refund(message: types.Message, command: CommandObject, state: FSMC
         await message.answer(refund_config.get("disabled_message", "⛔ Возвраты временно отключены"))
         return
 
-    if refund_config.get("admin_only", False):
-        if not (config.get("admin_ids") and message.from_user.id in config["admin_ids"]):
-            await message.answer("⛔ Эта команда доступна только администраторам")
-            return
+    is_admin = bool(config.get("admin_ids") and message.from_user.id in config["admin_ids"])
+
+    if refund_config.get("admin_only", False) and not is_admin:
+        await message.answer("⛔ Эта команда доступна только администраторам")
+        return
 
     if not command.args:
-        await message.answer("ℹ️ Используйте: /refund <ID_транзакции>")
+        await message.answer("ℹ️ Используйте: /refund <ID_транзакции или ID_пользователя>")
         return
 
     transaction_id = command.args.strip()
+    # Платежи, которые не удалось записать сразу, должны попасть в журнал до поиска
+    await user_store.flush()
+    payment = await asyncio.to_thread(get_payment, transaction_id)
+
+    if payment is None and transaction_id.isdigit():
+        payment = await asyncio.to_thread(get_last_payment, int(transaction_id))
+        if payment is None:
+            await message.answer("ℹ️ У пользователя нет платежей для возврата")
+            return
+
+    if payment is not None:
+        if not is_admin and payment["chat_id"] != message.from_user.id:
+            await message.answer("⛔ Можно вернуть только свой платеж")
+            return
+
+        if payment["refunded_at"] is not None:
+            await message.answer("ℹ️ Этот платеж уже был возвращен ранее")
+            return
+
+        transaction_id = payment["telegram_payment_charge_id"]
+        user_id = payment["chat_id"]
+        details = f"\n\n🔹 Пользователь: {user_id}\n🔹 Сумма: {payment['amount']} ⭐\n🔹 Платеж: {payment['payment']}"
+    else:
+        user_id = message.from_user.id
+        details = ""
 
-    await state.update_data(transaction_id=transaction_id)
+    await state.update_data(transaction_id=transaction_id, refund_user_id=user_id)
 
     confirm_kb = InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -785,7 +3179,7 @@ async def cmd_refund(message: types.Message, command: CommandObject, state: FSMC
     ])
 
     await message.answer(
-        "Вы уверены, что хотите вернуть оплату?",
+        f"Вы уверены, что хотите вернуть оплату?{details}",
         reply_markup=confirm_kb
     )
 
@@ -800,10 +3194,15 @@ async def confirm_refund(callback: types.CallbackQuery, state: FSMContext):
     try:
 
         await bot.refund_star_payment(
-            user_id=callback.from_user.id,
+            user_id=data.get("refund_user_id", callback.from_user.id),
             telegram_payment_charge_id=transaction_id
         )
 
+        try:
+            await user_store.mark_refunded(transaction_id)
+        except Exception as e:
+            logger.error(f"Не удалось отметить возврат {transaction_id}: {str(e)}")
+
         await callback.message.edit_text(
             "✅ Возврат успешно выполнен",
             reply_markup=None
@@ -817,6 +3216,7 @@ async def confirm_refund(callback: types.CallbackQuery, state: FSMContext):
             "already refunded",
             "уже возвращен"
         ]):
+            await user_store.mark_refunded(transaction_id)
             await callback.message.edit_text(
                 "ℹ️ Этот платеж уже был возвращен ранее",
                 reply_markup=None
@@ -844,14 +3244,16 @@ async def cmd_start(message: types.Message):
         message.chat.id,
         message.from_user.username,
         message.from_user.first_name,
-        message.from_user.last_name
+        message.from_user.last_name,
+        message.from_user.language_code
     )
 
-    if "/start" in config["commands"]:
-        await process_command(message.chat.id, config["commands"]["/start"])
+    commands = bundle_for(message.from_user.language_code).commands
+    if "/start" in commands:
+        await process_command(message.chat.id, commands["/start"])
 
 def register_commands():
-    for cmd in config["commands"]:
+    for cmd in default_bundle.commands:
         if cmd.startswith('/'):
             cmd_name = cmd[1:]
 
@@ -860,24 +3262,35 @@ def register_commands():
                     message.chat.id,
                     message.from_user.username,
                     message.from_user.first_name,
-                    message.from_user.last_name
+                    message.from_user.last_name,
+                    message.from_user.language_code
                 )
-                await process_command(message.chat.id, config["commands"][cmd])
+                await process_command(message.chat.id, bundle_for(message.from_user.language_code).commands[cmd])
 
             dp.message.register(command_handler, Command(cmd_name))
 
 register_commands()
 
 @dp.message(Command("msg"))
-async def cmd_msg(message: types.Message, state: FSMContext):
+async def cmd_msg(message: types.Message, command: CommandObject, state: FSMContext):
     if config.get("admin_ids") and message.from_user.id in config["admin_ids"]:
+        segment = (command.args or "").strip() or None
+
+        try:
+            compile_segment(segment)
+        except ValueError as e:
+            await message.answer(f"❌ {escape(str(e))}\nДоступные сегменты: <code>{SEGMENT_HELP}</code>")
+            return
+
         await message.answer(
             "📢 Введите сообщение для рассылки:\n"
             "• Можно отправить текст с форматированием\n"
-            "• Или фото с подписью\n"
+            "• Фото, видео, документ или альбом с подписью\n"
+            + (f"• Сегмент: <code>{escape(segment)}</code>\n" if segment else "") +
             "❌ Для отмены отправьте /cancel"
         )
 
+        await state.update_data(segment=segment)
         await state.set_state(BroadcastStates.waiting_for_message)
     else:
         await message.answer("⛔ У вас нет прав для этой команды")
@@ -887,56 +3300,157 @@ async def cancel_broadcast(message: types.Message, state: FSMContext):
     await message.answer("❌ Рассылка отменена")
     await state.clear()
 
+HTML_TAG_PATTERN = re.compile(r"</?(b|i|u|s|a|code|pre|blockquote|tg-spoiler)\b[^>]*>", re.IGNORECASE)
+
+album_buffers: Dict[str, List[Message]] = {}
+
+def copy_source(messages: List[Message]) -> dict:
+    """Описание сообщения администратора для рассылки (и для повтора из журнала доставки)"""
+    source = messages[0]
+
+    # HTML-теги, набранные текстом, как и раньше отправляются с parse_mode="HTML"
+    if len(messages) == 1 and source.text and not source.entities and HTML_TAG_PATTERN.search(source.text):
+        return {"type": "html", "text": source.text}
+
+    copy = {"type": "copy", "from_chat_id": source.chat.id, "message_ids": [item.message_id for item in messages]}
+
+    if len(messages) == 1 and source.caption and not source.caption_entities \
+            and HTML_TAG_PATTERN.search(source.caption):
+        copy["caption"] = source.caption
+
+    return copy
+
+def build_copy_sender(source: dict) -> Callable[[int], Awaitable[Any]]:
+    """Отправка копии сообщения администратора через copyMessage: сохраняются
+    форматирование, видео, документы и альбомы, а запрос не зависит от размера сообщения"""
+    if source["type"] == "html":
+        return queued(lambda chat_id: bot.send_message(chat_id=chat_id, text=source["text"], parse_mode="HTML"))
+
+    from_chat_id = source["from_chat_id"]
+    message_ids = source["message_ids"]
+
+    if len(message_ids) > 1:
+        return queued(lambda chat_id: bot.copy_messages(
+            chat_id=chat_id,
+            from_chat_id=from_chat_id,
+            message_ids=message_ids
+        ))
+
+    if "caption" in source:
+        return queued(lambda chat_id: bot.copy_message(
+            chat_id=chat_id,
+            from_chat_id=from_chat_id,
+            message_id=message_ids[0],
+            caption=source["caption"],
+            parse_mode="HTML"
+        ))
+
+    return queued(lambda chat_id: bot.copy_message(
+        chat_id=chat_id,
+        from_chat_id=from_chat_id,
+        message_id=message_ids[0]
+    ))
+
+def build_run_sender(source: Optional[dict]) -> Optional[Callable[[int], Awaitable[Any]]]:
+    """Восстанавливает отправку по источнику рассылки из журнала (для повтора неудачных)"""
+    if not source:
+        return None
+
+    source_type = source.get("type")
+
+    if source_type in ("copy", "html"):
+        return build_copy_sender(source)
+
+    if source_type in ("template", "template_command"):
+        if resolve_template_message(source["name"]) is None:
+            return None
+        segment = source.get("segment")
+        if source_type == "template":
+            return build_localized_sender(template_variants(source["name"]), build_template_sender, segment)
+        return build_localized_sender(template_variants(source["name"]), command_sender, segment)
+
+    if source_type == "scheduled":
+        message_data = (scheduled_messages.get(source["name"]) or {}).get("message")
+    else:
+        message_data = None
+
+    if message_data is None:
+        return None
+    return command_sender(message_data)
+
 @dp.message(BroadcastStates.waiting_for_message)
 async def process_broadcast_message(message: types.Message, state: FSMContext):
-    users = get_all_users()
+    if message.media_group_id:
+        album = album_buffers.setdefault(message.media_group_id, [])
+        album.append(message)
+        if len(album) > 1:
+            return
+
+        # Сообщения альбома приходят отдельными апдейтами, собираем их перед рассылкой
+        await asyncio.sleep(ALBUM_COLLECT_DELAY)
+        messages = sorted(album_buffers.pop(message.media_group_id), key=lambda item: item.message_id)
+    else:
+        messages = [message]
+
+    data = await state.get_data()
+    await state.clear()
+
+    source = copy_source(messages)
+    broadcast_jobs.start(
+        "/msg",
+        "msg",
+        lambda job: run_copy_broadcast(job, message, source, data.get("segment")),
+        source=source
+    )
+
+async def run_copy_broadcast(job: BroadcastJob, message: Message, source: dict,
+                             segment: Optional[str] = None):
+    """Рассылка копии сообщения администратора всем пользователям (или сегменту)"""
+    await user_store.flush()
+    users = take_recipient_snapshot(segment)
     total_users = len(users)
     processing_msg = await message.answer(f"⏳ Начинаю рассылку для {total_users} пользователей...")
 
-    success = 0
-    failed = 0
-
-    for chat_id in users:
-        try:
-            if message.photo:
-                await bot.send_photo(
-                    chat_id=chat_id,
-                    photo=message.photo[-1].file_id,
-                    caption=message.caption if message.caption else "",
-                    parse_mode="HTML"
-                )
-            elif message.text:
-                await bot.send_message(
-                    chat_id=chat_id,
-                    text=message.text,
-                    parse_mode="HTML"
-                )
-            success += 1
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            failed += 1
-            logger.error(f"Ошибка отправки в {chat_id}: {str(e)}")
+    report_progress = ProgressReporter(processing_msg, "📢 Рассылка /msg", job)
+    success, failed = await broadcast_to_users(users, build_copy_sender(source), report_progress, job)
 
+    status = "отменена" if job.cancelled.is_set() else "завершена"
     await processing_msg.edit_text(
-        f"✅ Рассылка завершена:\n"
+        f"✅ Рассылка {status}:\n"
         f"• Успешно: {success}\n"
         f"• Не удалось: {failed}\n"
         f"• Всего: {total_users}"
     )
-    await state.clear()
 
 @dp.message(Command("stats"))
-async def cmd_stats(message: types.Message):
+async def cmd_stats(message: types.Message, command: CommandObject):
     if config.get("admin_ids") and message.from_user.id in config["admin_ids"]:
+        segment = (command.args or "").strip() or None
+        await user_store.flush()
+
+        try:
+            segment_users = get_active_users_count(segment) if segment else None
+        except ValueError as e:
+            await message.answer(f"❌ {escape(str(e))}\nДоступные сегменты: <code>{SEGMENT_HELP}</code>")
+            return
+
         active_users = get_active_users_count()
         total_users = get_total_users_count()
         blocked_users = get_blocked_users_count()
 
+        revenue_lines = "".join(
+            f"\n• {escape(str(payment_name or '—'))}: {count} шт., {amount or 0} ⭐"
+            + (f" (возвратов: {refunded})" if refunded else "")
+            for payment_name, count, amount, refunded in get_revenue_stats()
+        )
+
         await message.answer(
             f"📊 Статистика бота:\n"
             f"• Активных пользователей: {active_users}\n"
             f"• Заблокированных: {blocked_users}\n"
             f"• Всего пользователей: {total_users}"
+            + (f"\n• В сегменте <code>{escape(segment)}</code>: {segment_users}" if segment else "")
+            + (f"\n\n💰 Оплаты:{revenue_lines}" if revenue_lines else "")
         )
     else:
         await message.answer("⛔ У вас нет прав для этой команды")
@@ -971,17 +3485,126 @@ async def cmd_unblock_user(message: types.Message):
     except Exception as e:
         await message.answer(f"❌ Ошибка: {str(e)}")
 
-@dp.message(F.text.in_(config.get("buttons", {}).keys()))
+@dp.message(Command("export"))
+async def cmd_export(message: types.Message, command: CommandObject):
+    if not (config.get("admin_ids") and message.from_user.id in config["admin_ids"]):
+        await message.answer("⛔ У вас нет прав для этой команды")
+        return
+
+    args = (command.args or "").split()
+    kind = args[0] if args else "users"
+    file_format = args[1] if len(args) > 1 else "csv"
+    if kind not in TRANSFER_TABLES or file_format not in TRANSFER_FORMATS:
+        await message.answer("Используйте: /export [users|blocked] [csv|jsonl|txt]")
+        return
+
+    await user_store.flush()
+    fd, path = tempfile.mkstemp(suffix=f".{file_format}")
+    os.close(fd)
+    try:
+        count = await asyncio.to_thread(export_table, kind, file_format, path)
+        if os.path.getsize(path) > TELEGRAM_UPLOAD_LIMIT:
+            await message.answer(
+                f"❌ Файл ({format_size(os.path.getsize(path))}) больше 50 МБ, которые бот может отправить. "
+                f"Выполните выгрузку на сервере: <code>{TRANSFER_CLI_HINT}</code>"
+            )
+            return
+        await message.answer_document(
+            FSInputFile(path, filename=f"{kind}_{datetime.now():%Y%m%d_%H%M}.{file_format}"),
+            caption=f"📦 Выгружено записей: {count}"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки {kind}: {str(e)}")
+        await message.answer(f"❌ Ошибка: {str(e)}")
+    finally:
+        os.remove(path)
+
+@dp.message(Command("import"))
+async def cmd_import(message: types.Message, command: CommandObject):
+    if not (config.get("admin_ids") and message.from_user.id in config["admin_ids"]):
+        await message.answer("⛔ У вас нет прав для этой команды")
+        return
+
+    document = message.document or (message.reply_to_message.document if message.reply_to_message else None)
+    kind = (command.args or "").strip() or "users"
+    file_format = Path(document.file_name or "").suffix.lstrip(".").lower() if document else None
+    if document is None or kind not in TRANSFER_TABLES or file_format not in TRANSFER_FORMATS:
+        await message.answer(
+            "Отправьте файл .csv, .jsonl или .txt с подписью /import [users|blocked] "
+            "или ответьте этой командой на сообщение с файлом"
+        )
+        return
+
+    if document.file_size and document.file_size > TELEGRAM_DOWNLOAD_LIMIT:
+        await message.answer(
+            f"❌ Файл больше 20 МБ, которые бот может скачать. "
+            f"Скопируйте его на сервер и выполните: <code>{TRANSFER_CLI_HINT}</code>"
+        )
+        return
+
+    progress_msg = await message.answer("⏳ Загружаем файл...")
+    fd, path = tempfile.mkstemp(suffix=f".{file_format}")
+    os.close(fd)
+    try:
+        await bot.download(document, destination=path)
+        if kind == "users":
+            await user_store.flush()
+        loaded, skipped = await asyncio.to_thread(import_file, kind, path, file_format)
+        logger.info(f"Импорт {kind} из {document.file_name}: загружено {loaded}, пропущено {skipped}")
+        await progress_msg.edit_text(
+            f"✅ Импорт завершен:\n"
+            f"• Загружено: {loaded}\n"
+            f"• Пропущено (нет chat_id или неверные данные): {skipped}"
+        )
+    except Exception as e:
+        logger.error(f"Ошибка импорта {kind}: {str(e)}")
+        await progress_msg.edit_text(f"❌ Ошибка: {escape(str(e))}")
+    finally:
+        os.remove(path)
+
+@dp.message(Command("maintenance"))
+async def cmd_maintenance(message: types.Message):
+    if not (config.get("admin_ids") and message.from_user.id in config["admin_ids"]):
+        await message.answer("⛔ У вас нет прав для этой команды")
+        return
+
+    progress_msg = await message.answer("⏳ Обслуживание базы данных...")
+    await user_store.flush()
+    await delivery_log.flush()
+    try:
+        result = await asyncio.to_thread(run_db_maintenance)
+    except Exception as e:
+        logger.error(f"Ошибка обслуживания базы: {str(e)}")
+        await progress_msg.edit_text(f"❌ Ошибка: {escape(str(e))}")
+        return
+
+    table_lines = "".join(
+        f"\n• {table}: {rows} строк"
+        + (f", {format_size(size)} + индексы {format_size(index_size)}" if size is not None else "")
+        for table, rows, size, index_size in result["tables"]
+    )
+    await progress_msg.edit_text(
+        f"🛠 Обслуживание завершено:\n"
+        f"• Статистика планировщика обновлена (ANALYZE)\n"
+        f"• Созданы индексы: {', '.join(result['created_indexes']) or 'не требуется'}\n"
+        + ("• База переведена в режим auto_vacuum=INCREMENTAL\n" if result["converted"] else "")
+        + f"• Освобождено: {format_size(result['freed'])}\n"
+        f"• Размер базы: {format_size(result['file_size'])}\n"
+        f"\n📁 Таблицы:{table_lines}"
+    )
+
+@dp.message(F.text.in_(default_bundle.buttons.keys()))
 async def handle_reply_buttons(message: types.Message):
     save_user(
         message.chat.id,
         message.from_user.username,
         message.from_user.first_name,
-        message.from_user.last_name
+        message.from_user.last_name,
+        message.from_user.language_code
     )
-    await process_command(message.chat.id, config["buttons"][message.text])
+    await process_command(message.chat.id, bundle_for(message.from_user.language_code).buttons[message.text])
 
-@dp.callback_query(F.data.in_(config.get("buttons", {}).keys()))
+@dp.callback_query(F.data.in_(default_bundle.buttons.keys()))
 async def handle_inline_buttons(callback: types.CallbackQuery):
     await callback.answer()
 
@@ -989,10 +3612,11 @@ async def handle_inline_buttons(callback: types.CallbackQuery):
         callback.message.chat.id,
         callback.from_user.username,
         callback.from_user.first_name,
-        callback.from_user.last_name
+        callback.from_user.last_name,
+        callback.from_user.language_code
     )
 
-    button_data = config["buttons"][callback.data]
+    button_data = bundle_for(callback.from_user.language_code).buttons[callback.data]
 
     if not (isinstance(button_data, dict) and "url" in button_data):
         await process_command(callback.message.chat.id, button_data)
@@ -1005,11 +3629,13 @@ async def handle_all_inline_buttons(callback: types.CallbackQuery):
         callback.from_user.id,
         callback.from_user.username,
         callback.from_user.first_name,
-        callback.from_user.last_name
+        callback.from_user.last_name,
+        callback.from_user.language_code
     )
 
-    if callback.data in config.get("buttons", {}):
-        button_data = config["buttons"][callback.data]
+    buttons = bundle_for(callback.from_user.language_code).buttons
+    if callback.data in buttons:
+        button_data = buttons[callback.data]
 
         if not (isinstance(button_data, dict) and "url" in button_data):
             await process_command(callback.message.chat.id, button_data)
@@ -1026,69 +3652,234 @@ async def handle_unknown(message: types.Message):
         message.chat.id,
         message.from_user.username,
         message.from_user.first_name,
-        message.from_user.last_name
+        message.from_user.last_name,
+        message.from_user.language_code
     )
 
+    unknown_message = bundle_for(message.from_user.language_code).unknown_message
     if message.text and message.text.startswith('/'):
         await send_response(
             message.chat.id,
-            config.get("unknown_message", {"text": "Неизвестная команда"})
+            unknown_message or {"text": "Неизвестная команда"}
         )
     elif message.text:  
         await send_response(
             message.chat.id,
-            config.get("unknown_message", {"text": "Пожалуйста, используйте команды из меню"})
+            unknown_message or {"text": "Пожалуйста, используйте команды из меню"}
         )
 
+inline_config = config.get("inline") or {}
+INLINE_CACHE_TIME = inline_config.get("cache_time", 300)
+INLINE_PAGE_SIZE = 50
+INLINE_PREFIX_LIMIT = 20
+INLINE_TOKEN_PATTERN = re.compile(r"\w+")
+
+def inline_tokens(text: str) -> Set[str]:
+    return set(INLINE_TOKEN_PATTERN.findall(HTML_TAG_PATTERN.sub(" ", text).lower()))
+
+class InlineEntry:
+    """Кнопка или шаблон, которые можно отправить через инлайн-режим"""
+
+    __slots__ = ("title", "text", "description", "image", "reply_markup")
+
+    def __init__(self, title: str, text: str, image: Optional[str], reply_markup: Optional[InlineKeyboardMarkup]):
+        self.title = title
+        self.text = text
+        self.description = " ".join(HTML_TAG_PATTERN.sub("", text).split())[:100]
+        self.image = image
+        self.reply_markup = reply_markup
+
+def inline_url_keyboard(buttons) -> Optional[InlineKeyboardMarkup]:
+    """В чужом чате работают только кнопки-ссылки: нажатия callback-кнопок там некому обработать"""
+    markup = get_inline_keyboard(buttons)
+    if markup is None:
+        return None
+    rows = [[button for button in row if button.url] for row in markup.inline_keyboard]
+    rows = [row for row in rows if row]
+    return InlineKeyboardMarkup(inline_keyboard=rows) if rows else None
+
+def inline_entry(title: str, message_data, is_template: bool) -> Optional[InlineEntry]:
+    """Сообщение из нескольких частей склеивается в одно: текст частей, первое изображение, кнопки последней"""
+    parts = [part for part in (message_data if isinstance(message_data, list) else [message_data])
+             if isinstance(part, dict)]
+    if not parts:
+        return None
+
+    texts = [(part.get("text") or "").strip() for part in parts]
+    if is_template:
+        texts = [MessageTemplate(text).render() for text in texts]
+    images = [path for path in collect_images(parts) if os.path.exists(path)]
+
+    return InlineEntry(
+        title,
+        "\n\n".join(text for text in texts if text),
+        images[0] if images else None,
+        inline_url_keyboard(parts[-1].get("inline_buttons"))
+    )
+
+class InlineIndex:
+    """Поиск для инлайн-режима: префиксы слов заголовка и текста заранее разложены по словарю,
+    запрос - пересечение множеств записей по префиксам своих слов. Совпадения в заголовке выше"""
+
+    def __init__(self, entries: List[InlineEntry]):
+        self.entries = entries
+        self.prefixes: Dict[str, Set[int]] = {}
+        self.title_prefixes: List[Set[str]] = []
+
+        for number, entry in enumerate(entries):
+            title_prefixes = {
+                token[:end] for token in inline_tokens(entry.title)
+                for end in range(1, min(len(token), INLINE_PREFIX_LIMIT) + 1)
+            }
+            self.title_prefixes.append(title_prefixes)
+            for token in inline_tokens(entry.title) | inline_tokens(entry.text):
+                for end in range(1, min(len(token), INLINE_PREFIX_LIMIT) + 1):
+                    self.prefixes.setdefault(token[:end], set()).add(number)
+
+    def search(self, query: str) -> List[int]:
+        tokens = [token[:INLINE_PREFIX_LIMIT] for token in inline_tokens(query)]
+        if not tokens:
+            return list(range(len(self.entries)))
+
+        matches = set.intersection(*(self.prefixes.get(token, set()) for token in tokens))
+        return sorted(matches, key=lambda number: (not all(token in self.title_prefixes[number] for token in tokens),
+                                                   number))
+
+def build_inline_index() -> InlineIndex:
+    entries = [
+        inline_entry(name, data, False)
+        for name, data in (config.get("buttons") or {}).items()
+        if not (isinstance(data, dict) and "url" in data)
+    ]
+    if inline_config.get("templates", True):
+        entries.extend(inline_entry(name, resolve_template_message(name), True) for name in template_messages)
+    return InlineIndex([entry for entry in entries if entry is not None])
+
+inline_index = build_inline_index()
+
+@lru_cache(maxsize=1024)
+def inline_results(query: str, media_version: int) -> tuple:
+    """Готовые результаты запроса. media_version (число известных file_id) сбрасывает кэш,
+    когда изображения записей загружаются в Telegram и их можно отдать по file_id"""
+    results = []
+    for number in inline_index.search(query):
+        entry = inline_index.entries[number]
+        file_id = media_cache.file_ids.get(media_cache.file_key(entry.image)) if entry.image else None
+
+        if file_id:
+            results.append(InlineQueryResultCachedPhoto(
+                id=str(number),
+                photo_file_id=file_id,
+                title=entry.title,
+                description=entry.description,
+                caption=entry.text,
+                parse_mode="HTML",
+                reply_markup=entry.reply_markup
+            ))
+        elif entry.text:
+            results.append(InlineQueryResultArticle(
+                id=str(number),
+                title=entry.title,
+                description=entry.description,
+                input_message_content=InputTextMessageContent(message_text=entry.text, parse_mode="HTML"),
+                reply_markup=entry.reply_markup
+            ))
+    return tuple(results)
+
+@dp.inline_query()
+async def handle_inline_query(inline_query: types.InlineQuery):
+    if is_user_blocked(inline_query.from_user.id):
+        await inline_query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True)
+        return
+
+    query = " ".join(inline_query.query.lower().split())
+    results = inline_results(query, len(media_cache.file_ids))
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    next_offset = offset + INLINE_PAGE_SIZE
+
+    await inline_query.answer(
+        list(results[offset:next_offset]),
+        cache_time=INLINE_CACHE_TIME,
+        next_offset=str(next_offset) if next_offset < len(results) else ""
+    )
+
 dp.message.middleware(check_user_blocked_middleware)
+dp.callback_query.middleware(CallbackDebounceMiddleware(CALLBACK_DEBOUNCE))
 
 async def on_startup():
-    logger.info("Бот запущен!")
+    lifecycle.spawn(user_store.run(), name="user_store")
+    lifecycle.spawn(delivery_log.run(), name="delivery_log")
     await setup_broadcasts()
-    await set_bot_commands()
-
-async def set_bot_commands():
+    # Сетевые вызовы при запуске не зависят друг от друга
+    await asyncio.gather(set_bot_commands(), preload_broadcast_media())
+    logger.info(f"Бот запущен! Время запуска: {monotonic() - STARTED_AT:.2f} сек.")
+
+async def preload_broadcast_media():
+    """Загружает изображения рассылок в media_cache_chat заранее, а не при первой рассылке"""
+    paths = []
+    for message_data in [*scheduled_messages.values(), *template_messages.values()]:
+        if isinstance(message_data, dict):
+            paths.extend(collect_images(message_data.get("message", message_data)))
+    await media_cache.preload(paths)
+
+def menu_commands(bundle: ContentBundle) -> List[types.BotCommand]:
     commands = []
-    for cmd, data in config["commands"].items():
+    for cmd, data in bundle.menu.items():
         if cmd.startswith('/') and "description" in data:
             command = cmd.lstrip('/')
             description = data["description"]
             commands.append(types.BotCommand(command=command, description=description))
+    return commands
+
+async def set_bot_commands():
+    # Меню по умолчанию и отдельное меню для каждого языка из раздела languages
+    menus = {None: menu_commands(default_bundle)}
+    for language, bundle in content_bundles.items():
+        if bundle is not default_bundle:
+            menus[language] = menu_commands(bundle)
+
+    if any(menus.values()):
+        # Меню команд хранится на стороне Telegram, повторно отправляем его только после изменений
+        state_key = f"commands_hash:{bot.id}"
+        commands_hash = hashlib.sha256(json.dumps(
+            [[language, [command.model_dump() for command in commands]] for language, commands in menus.items()],
+            ensure_ascii=False
+        ).encode()).hexdigest()
+        if await asyncio.to_thread(get_bot_state, state_key) == commands_hash:
+            logger.info("Команды бота не изменились")
+            return
 
-    if commands:
-        await bot.set_my_commands(commands)
+        for language, commands in menus.items():
+            if commands:
+                await bot.set_my_commands(commands, language_code=language)
+        await asyncio.to_thread(set_bot_state, state_key, commands_hash)
         logger.info("Команды бота обновлены")
 
+async def on_shutdown():
+    logger.info("Получен сигнал остановки, завершаем работу...")
+    await lifecycle.shutdown(SHUTDOWN_TIMEOUT)
+
+    if lifecycle.last_update_id is not None:
+        try:
+            await bot.get_updates(offset=lifecycle.last_update_id + 1, limit=1, timeout=0)
+        except Exception as e:
+            logger.error(f"Не удалось подтвердить обработанные апдейты: {str(e)}")
+
 async def run_bot():
-    global loop
-    loop = asyncio.get_event_loop()
     dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
 
-    try:
-        await dp.start_polling(bot)
-    except asyncio.CancelledError:
-        pass
-    finally:
-        await bot.session.close()
+    # Общую сессию и сигналы остановки при запуске нескольких ботов обрабатывает bot_host.py
+    await dp.start_polling(bot, close_bot_session=not BOT_NAME, handle_signals=not BOT_NAME)
 
 def start_bot():
-    global bot_task
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-
     try:
-        bot_task = loop.run_until_complete(run_bot())
+        asyncio.run(run_bot())
     except KeyboardInterrupt:
         pass
-    finally:
-        loop.close()
-        sys.exit(0)
 
 if __name__ == "__main__":
-    try:
-        start_bot()
-    except SystemExit:
-        os._exit(0)
-
+    if sys.argv[1:2] in (["export"], ["import"]):
+        sys.exit(transfer_cli(sys.argv[1:]))
+    start_bot()
     logger.info("Бот остановлен")
-    os._exit(0)